@@ -1,46 +1,55 @@
 import os
 import sys
 import argparse
-import librosa
-import numpy as np
-from natsort import natsorted
-from util.dataset import compute_features
+
+# Imported before main() runs (and timed by timbremap.py --timing)
+REQUIRES = ('numpy', 'librosa', 'soundfile', 'natsort', 'util.dataset')
 
 # Feature function supplied to compute_features (in util.dataset)
 def compute_melspec(samples, fs):
+	import librosa
 	return librosa.feature.melspectrogram(
-		y=samples, 
+		y=samples,
 		sr=fs,
 		n_fft=2048,
 		hop_length=128,
 		power=2)
 
+# Arguments
+def add_arguments(parser):
+	parser.add_argument('data_dir', help='data directory')
+
 # Main
 # -------------------------------------------------------------------------- #
-# Parser for data directory argument
-parser = argparse.ArgumentParser(description='Compute Mel-scaled spectrogram features')
-parser.add_argument('data_dir', help='data directory')
-args = parser.parse_args()
-
-# Verify data directory exists
-if not os.path.exists(args.data_dir):
-	print("Data directory \"%s\" not found", args.data_dir)
-	sys.exit()
-
-# Verify wavs directory exists
-wav_dir = os.path.join(args.data_dir, 'wavs')
-if not os.path.exists(wav_dir):
-	print("Wavs sub-directory \"%s\" not found", wav_dir)
-	sys.exit()
-
-# Get list of files in the wav directory
-wav_files = [os.path.join(wav_dir, f) for f in os.listdir(wav_dir) if not f.startswith('.')]
-wav_files = natsorted(wav_files)	# Sort by file name (names should be ex_#)
-
-# Compute a numpy array of mel spectrograms of standardized width
-melspecs = compute_features(wav_files, compute_melspec, equal_width=True)
-
-# Save
-print("Saving features...\n")
-np.save(os.path.join(args.data_dir, 'features'), melspecs)
-
+def main(args):
+	import numpy as np
+	from natsort import natsorted
+	from util.dataset import compute_features
+
+	# Verify data directory exists
+	if not os.path.exists(args.data_dir):
+		print("Data directory \"%s\" not found" % args.data_dir)
+		sys.exit()
+
+	# Verify wavs directory exists
+	wav_dir = os.path.join(args.data_dir, 'wavs')
+	if not os.path.exists(wav_dir):
+		print("Wavs sub-directory \"%s\" not found" % wav_dir)
+		sys.exit()
+
+	# Get list of files in the wav directory
+	wav_files = [os.path.join(wav_dir, f) for f in os.listdir(wav_dir) if not f.startswith('.')]
+	wav_files = natsorted(wav_files)	# Sort by file name (names should be ex_#)
+
+	# Compute a numpy array of mel spectrograms of standardized width
+	melspecs = compute_features(wav_files, compute_melspec, equal_width=True)
+
+	# Save
+	print("Saving features...\n")
+	np.save(os.path.join(args.data_dir, 'features'), melspecs)
+
+if __name__ == '__main__':
+	# Parser for data directory argument
+	parser = argparse.ArgumentParser(description='Compute Mel-scaled spectrogram features')
+	add_arguments(parser)
+	main(parser.parse_args())
@@ -1,35 +1,66 @@
 import os
 import sys
 import argparse
-import numpy as np
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
-from util.dataset import *
-from util.models import *
-from util.tests import *
 
-# Create parser for command line arguments
-parser = argparse.ArgumentParser(
-	description='Plot TimbreMap model latent space distributions')
+# Imported before main() runs (and timed by timbremap.py --timing)
+REQUIRES = ('numpy', 'util.plots', 'util.dataset')
 
-# Positional arguments 
-parser.add_argument('model_dir', help='model directory')
+# Arguments
+def add_arguments(parser):
 
-# Parse
-args = parser.parse_args()
+	# Positional arguments
+	parser.add_argument('model_dir', help='model directory')
 
-# Verify data directory exists
-if not os.path.exists(args.model_dir):
-	print("Model directory \"%s\" does not exist" % args.model_dir)
-	sys.exit()
+	# Optional arguments
+	parser.add_argument('--labels', default=None,
+		help='data directory the model was trained on, to color by a parameter')
+	parser.add_argument('--param', type=int, default=0, help='label column to color by')
+	parser.add_argument('--file_order', action='store_true',
+		help='use labels in file order if the model\'s partition isn\'t known')
+	parser.add_argument('--bins', type=int, default=64, help='2-D histogram bins per dimension')
+	parser.add_argument('--bins_3d', type=int, default=16, help='3-D histogram bins per dimension')
+	parser.add_argument('--show', action='store_true',
+		help='show interactive 3-D scatter plots instead of writing PNGs')
+	parser.add_argument('--max_points', type=int, default=5000,
+		help='points per scatter plot with --show')
 
-# Load the latent space data
-latent = np.load(os.path.join(args.model_dir, 'latent.npy'))
-try:
-	latent_pca = np.load(os.path.join(args.model_dir, 'latent_pca.npy'))
-	scatter_latent(latent, z_projected=latent_pca)
-except:
-	scatter_latent(latent)
+def main(args):
+	import numpy as np
+	from util.plots import scatter_latent, plot_latent_density
+	from util.dataset import load_labels
 
+	# Verify data directory exists
+	if not os.path.exists(args.model_dir):
+		print("Model directory \"%s\" does not exist" % args.model_dir)
+		sys.exit()
 
+	# Load the latent space data
+	latent = np.load(os.path.join(args.model_dir, 'latent.npy'), mmap_mode='r')
+	try:
+		latent_pca = np.load(os.path.join(args.model_dir, 'latent_pca.npy'), mmap_mode='r')
+	except FileNotFoundError:
+		latent_pca = None
 
+	# Interactive scatter plots
+	if args.show:
+		scatter_latent(latent, z_projected=latent_pca, max_points=args.max_points)
+		return
+
+	# Density plots, written to model_dir/latent.png (and latent_pca.png)
+	labels = None
+	if args.labels is not None:
+		labels = load_labels(args.labels, args.model_dir, args.file_order)
+	for name, z in (('latent', latent), ('latent_pca', latent_pca)):
+		if z is None:
+			continue
+		f_path = os.path.join(args.model_dir, name + '.png')
+		plot_latent_density(f_path, z, labels, args.param, args.bins, args.bins_3d,
+			title='%s (%d points)' % (name, len(z)))
+		print("Wrote %s" % f_path)
+
+if __name__ == '__main__':
+	# Create parser for command line arguments
+	parser = argparse.ArgumentParser(
+		description='Plot TimbreMap model latent space distributions')
+	add_arguments(parser)
+	main(parser.parse_args())
@@ -0,0 +1,198 @@
+import os
+import sys
+import time
+import argparse
+import importlib
+
+# TimbreMap command line interface
+# ================================
+#
+# Subcommands import their dependencies only when they run, so the runtime
+# commands (export, check, render, plot, validate) never load Keras, TensorFlow,
+# or sklearn. With --timing, the time spent importing each command's
+# dependencies is reported separately from the time spent running it.
+#
+# usage: timbremap.py [--timing] {features,train,export,check,render,plot,validate} ...
+
+# Export: rebuild runtime (and numpy encoder) exports from saved Keras models
+EXPORT_REQUIRES = ('numpy', 'h5py', 'util.export', 'util.inference', 'util.tests',
+	'util.quantize', 'util.sensitivity')
+
+# Sensitivity atlas grid size argument: 0 (no atlas), or at least 2
+def atlas_size(arg):
+	n = int(arg)
+	if n == 1 or n < 0:
+		raise argparse.ArgumentTypeError('atlas size must be 0 or at least 2')
+	return n
+
+def add_export_arguments(parser):
+	parser.add_argument('model_dir', help='model directory')
+	group = parser.add_mutually_exclusive_group()
+	group.add_argument('--pca', dest='pca', action='store_true', default=None,
+		help='use principal component analysis (default: if latent_pca.npy exists)')
+	group.add_argument('--no_pca', dest='pca', action='store_false',
+		help='don\'t use principal component analysis')
+	parser.add_argument('--atlas_size', type=atlas_size, default=17,
+		help='sensitivity atlas grid points per control axis (0 to skip)')
+	parser.add_argument('--quantize', type=int, choices=(8, 16), action='append',
+		help='also export a fixed-point model to model_dir/timbremap_int<bits>')
+
+def export_main(args):
+	from util.export import export_model
+	from util.inference import export_encoder
+	from util.tests import test_max
+	from util.quantize import quantize_model, quantize_report
+	from util.sensitivity import export_sensitivity_atlas
+	p_dir = export_model(args.model_dir, use_pca=args.pca)
+	export_encoder(os.path.join(args.model_dir, 'keras'),
+		os.path.join(args.model_dir, 'encoder'))
+	print("Error: %f" % test_max(p_dir))
+	if args.atlas_size:
+		export_sensitivity_atlas(p_dir, args.atlas_size)
+	for bits in (args.quantize or []):
+		q_dir = quantize_model(p_dir, os.path.join(args.model_dir, 'timbremap_int%d' % bits), bits)
+		report = quantize_report(p_dir, q_dir)
+		print("int%d: max. error %.2f steps (mean %.2f), max. error vs. rounded %d steps" % (
+			bits, report['max_err'], report['mean_err'], report['max_step_err']))
+		print("int%d: round-trip error %.2f steps (float: %.2f)" % (
+			bits, report['round_trip_err'], report['float_round_trip_err']))
+
+# Check: verify invertibility of an exported runtime model
+CHECK_REQUIRES = ('numpy', 'util.tests')
+
+def add_check_arguments(parser):
+	parser.add_argument('model_dir', help='model directory')
+	parser.add_argument('--scale_mode', default='uniform', choices=('uniform', 'normal'),
+		help='control to latent space scaling')
+	parser.add_argument('--benchmark', action='store_true',
+		help='also time the runtime layer prototypes (float32)')
+
+def check_main(args):
+	from util.tests import test_max, test_jacobian, benchmark_layers
+	p_dir = os.path.join(args.model_dir, 'timbremap')
+	print("Error: %f" % test_max(p_dir, scale_mode=args.scale_mode))
+	print("Jacobian error: %f" % test_jacobian(p_dir))
+	if args.benchmark:
+		benchmark_layers(p_dir)
+
+# Render: map a control trajectory to parameter automation
+RENDER_REQUIRES = ('numpy', 'util.trajectory')
+
+def add_render_arguments(parser):
+	parser.add_argument('model_dir', help='model directory')
+	parser.add_argument('controls', help='T x latent_size controls in [0, 1] (.npy or .csv)')
+	parser.add_argument('out_file', help='output automation (.csv or .mid)')
+	parser.add_argument('--frame_rate', type=float, default=1000.0, help='control frames per second')
+	parser.add_argument('--smooth', type=float, default=None, help='lowpass time constant (frames)')
+	parser.add_argument('--max_rate', type=float, default=None, help='max. events per second per parameter')
+	parser.add_argument('--no_dedupe', dest='dedupe', action='store_false',
+		help='emit every parameter for every rendered frame')
+	parser.add_argument('--chunk', type=int, default=65536, help='frames per chunk')
+
+def render_main(args):
+	import numpy as np
+	from util.trajectory import render_trajectory
+	if args.controls.endswith('.npy'):
+		c = np.load(args.controls, mmap_mode='r')
+	else:
+		c = np.loadtxt(args.controls, delimiter=',', ndmin=2)
+	t = time.time()
+	n = render_trajectory(os.path.join(args.model_dir, 'timbremap'), c, args.out_file,
+		frame_rate=args.frame_rate, max_rate=args.max_rate, smooth=args.smooth,
+		dedupe=args.dedupe, chunk_size=args.chunk)
+	t = time.time() - t
+	print("Rendered %d frames to %d events (%.0f frames/s)" % (len(c), n, len(c) / t))
+
+# Validate: rebuild and check every exported model under a directory
+VALIDATE_REQUIRES = ('numpy', 'h5py', 'util.export', 'util.tests', 'util.validate')
+
+def add_validate_arguments(parser):
+	parser.add_argument('root', nargs='?', default='patches',
+		help='directory searched for models (default: patches)')
+	parser.add_argument('--workers', type=int, default=None,
+		help='number of processes (default: number of CPUs)')
+	parser.add_argument('--write', action='store_true',
+		help='rebuild exports in place rather than in a scratch directory')
+	parser.add_argument('--tol', type=float, default=1e-5, help='max. error to pass')
+	parser.add_argument('--report', default=None, help='write the full report as JSON')
+
+def validate_main(args):
+	import json
+	from util.validate import find_models, validate_models
+	model_dirs = find_models(args.root)
+	if not model_dirs:
+		print("No models found in \"%s\"" % args.root)
+		sys.exit(1)
+	t = time.time()
+	reports = validate_models(model_dirs, args.workers, args.write, args.tol)
+	t = time.time() - t
+	print('%-45s %-6s %9s %9s %9s %9s %9s %7s %7s' % ('model', 'result', 'rebuild',
+		'text', 'inverse', 'round', 'export s', 'fwd ns', 'bwd ns'))
+	for r in reports:
+		if 'error' in r:
+			print('%-45s %-6s' % (r['model_dir'], 'ERROR'))
+			print(r['error'])
+			continue
+		print('%-45s %-6s %9.2e %9.2e %9.2e %9.2e %9.3f %7.1f %7.1f' % (r['model_dir'],
+			'pass' if r['passed'] else 'FAIL',
+			max(r['rebuild'].values()), max(r['text'].values()), max(r['inverse'].values()),
+			r['round_trip_err'], r['export_sec'], r['forward_ns'], r['backward_ns']))
+	n_passed = sum(r['passed'] for r in reports)
+	print("%d of %d models passed (%.1f s)" % (n_passed, len(reports), t))
+	if args.report is not None:
+		with open(args.report, 'w') as fh:
+			json.dump(reports, fh, indent=1)
+	if n_passed < len(reports):
+		sys.exit(1)
+
+# Commands by name: (help, add_arguments, main, requires). Script
+# modules are light to import; their heavy dependencies are listed in REQUIRES.
+def get_commands():
+	commands = {}
+	for name, module, desc in (
+			('features', 'compute_melspecs', 'compute Mel-scaled spectrogram features'),
+			('train', 'train', 'train TimbreMap models'),
+			('plot', 'plot_latent', 'plot latent space distributions')):
+		m = importlib.import_module(module)
+		commands[name] = (desc, m.add_arguments, m.main, m.REQUIRES)
+	commands['export'] = ('rebuild runtime exports from saved Keras models',
+		add_export_arguments, export_main, EXPORT_REQUIRES)
+	commands['check'] = ('verify invertibility of runtime models',
+		add_check_arguments, check_main, CHECK_REQUIRES)
+	commands['render'] = ('render control trajectories to parameter automation',
+		add_render_arguments, render_main, RENDER_REQUIRES)
+	commands['validate'] = ('rebuild and check all exported models under a directory',
+		add_validate_arguments, validate_main, VALIDATE_REQUIRES)
+	return commands
+
+def main(argv=None):
+	t_start = time.time()
+	parser = argparse.ArgumentParser(description='TimbreMap')
+	parser.add_argument('--timing', action='store_true',
+		help='report import and run times')
+	subparsers = parser.add_subparsers(dest='command')
+	commands = get_commands()
+	for name in ('features', 'train', 'export', 'check', 'render', 'plot', 'validate'):
+		desc, add_arguments, _, _ = commands[name]
+		add_arguments(subparsers.add_parser(name, help=desc, description=desc))
+	args = parser.parse_args(argv)
+	if args.command is None:
+		parser.print_help()
+		sys.exit(1)
+	_, _, command_main, requires = commands[args.command]
+
+	# Import (and time) the command's dependencies, then run it
+	t_import = time.time()
+	for module in requires:
+		importlib.import_module(module)
+	t_run = time.time()
+	command_main(args)
+	t_end = time.time()
+	if args.timing:
+		print("startup: %.1f ms, imports: %.1f ms, run: %.1f ms" % (
+			(t_import - t_start) * 1000,
+			(t_run - t_import) * 1000,
+			(t_end - t_run) * 1000))
+
+if __name__ == '__main__':
+	main()
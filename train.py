@@ -1,140 +1,240 @@
 import os
 import sys
+import shutil
 import argparse
-from util.dataset import *
-from util.models import *
-from util.tests import *
-
-# Create parser for command line arguments
-parser = argparse.ArgumentParser(description='Train TimbreMap models')
-
-# Positional arguments 
-parser.add_argument('data_dir', help='data directory')
-parser.add_argument('model_dir', help='model directory')
-
-# Mutually-exclusive group (one required)
-group = parser.add_mutually_exclusive_group(required=True)
-group.add_argument('--dnn', action='store_true', help='use dnn encoder')
-group.add_argument('--cnn', action='store_true', help='use cnn encoder')
-group.add_argument('--lstm', action='store_true', help='use lstm encoder')
-
-# Optional arguments
-parser.add_argument('--gen', action='store_true', help='use generative latent encoding')
-parser.add_argument('--pca', action='store_true', help='use principal component analysis')
-parser.add_argument('--epochs', type=int, default=10, help='number of epochs')
-parser.add_argument('--batch', type=int, default=32, help='batch size')
-parser.add_argument('--latent_size', type=int, default=3,  help='latent size')
-
-# Parse
-args = parser.parse_args()
-
-# Verify data directory exists
-if not os.path.exists(args.data_dir):
-	print("Data directory \"%s\" does not exist" % args.data_dir)
-	sys.exit()
-
-# Make model directory if it doesn't exist
-if not os.path.exists(args.model_dir):
-	os.makedirs(args.model_dir)
-
-# =====================
-# Load/Preprocess Data:
-# =====================
-
-# Load training and testing partitions
-(x_train, y_train), (x_test, y_test) = load_data(args.data_dir)
-
-# Standardize
-x_train, x_test = standardize(x_train, x_test)
-
-# =============
-# Build Models:
-# =============
-
-# Build specified encoder model
-if args.dnn:
-	numel = np.prod(x_train.shape[1:])
-	encoder = build_encoder_dnn(
-		input_shape=x_train.shape[1:], 
-		latent_size=args.latent_size,
-		dense_sizes=(numel//4, numel//16),
-		generative=args.gen)
-
-elif args.cnn:
-	# Add an explicit channel dimension to our grayscale images so the data has 
+
+# Imported before main() runs (and timed by timbremap.py --timing)
+REQUIRES = ('numpy', 'util.dataset', 'util.models', 'util.export', 'util.tests',
+	'util.inference', 'util.sensitivity', 'util.parallel')
+
+# Arguments
+def add_arguments(parser):
+
+	# Positional arguments
+	parser.add_argument('data_dir', help='data directory')
+	parser.add_argument('model_dir', help='model directory')
+
+	# Mutually-exclusive group (one required)
+	group = parser.add_mutually_exclusive_group(required=True)
+	group.add_argument('--dnn', action='store_true', help='use dnn encoder')
+	group.add_argument('--cnn', action='store_true', help='use cnn encoder')
+	group.add_argument('--lstm', action='store_true', help='use lstm encoder')
+
+	# Optional arguments
+	parser.add_argument('--gen', action='store_true', help='use generative latent encoding')
+	parser.add_argument('--pca', action='store_true', help='use principal component analysis')
+	parser.add_argument('--epochs', type=int, default=10, help='number of epochs')
+	parser.add_argument('--batch', type=int, default=32, help='batch size')
+	parser.add_argument('--latent_size', type=int, default=3,  help='latent size')
+	parser.add_argument('--eval_batch', type=int, default=256, help='evaluation batch size')
+
+	# Checkpointing and early stopping
+	parser.add_argument('--resume', action='store_true',
+		help='resume from the last checkpoint in model_dir/checkpoint')
+	parser.add_argument('--checkpoint_period', type=int, default=1,
+		help='epochs between checkpoints')
+	parser.add_argument('--patience', type=int, default=None,
+		help='stop after this many epochs without test loss improvement')
+	parser.add_argument('--min_delta', type=float, default=0.0,
+		help='minimum test loss decrease counted as improvement')
+
+	# Data-parallel training
+	parser.add_argument('--workers', type=int, default=1,
+		help='number of training processes (data-parallel, averaging weights)')
+	parser.add_argument('--sync_every', type=int, default=1,
+		help='batches per worker between weight averaging')
+	parser.add_argument('--benchmark_workers', type=int, nargs='+', default=None,
+		help='measure training throughput for these worker counts and exit')
+
+	# Partition arguments (used when creating a partition not yet in the manifest)
+	parser.add_argument('--partition', default='default',
+		help='partition name in partitions.json (one per distinct partition)')
+	parser.add_argument('--seed', type=int, default=0, help='partition seed')
+	parser.add_argument('--test_ratio', type=float, default=0.1, help='test set ratio')
+	parser.add_argument('--folds', type=int, default=None, help='number of folds for k-fold partitions')
+	parser.add_argument('--fold', type=int, default=0, help='test fold for k-fold partitions')
+	parser.add_argument('--stratify', type=int, nargs='+', default=None,
+		help='label columns to stratify on')
+	parser.add_argument('--bins', type=int, default=4, help='label ranges per stratified column')
+
+# Partition arguments for load_data
+def partition_kwargs(args):
+	kwargs = {'seed': args.seed}
+	if args.stratify is not None:
+		kwargs.update(method='stratified', columns=args.stratify, bins=args.bins)
+	elif args.folds:
+		kwargs['method'] = 'kfold'
+	if args.folds:
+		kwargs.update(k=args.folds, fold=args.fold)
+	return kwargs
+
+def main(args):
+	import numpy as np
+	from util.dataset import load_data, standardize, save_model_partition
+	from util.models import build_model, model_eval, export_keras, test_encoder, \
+		export_regressor, TrainingCheckpoint, resume_training
+	from util.export import export_latent, encode_batches
+	from util.tests import test_max
+	from util.inference import export_encoder
+	from util.sensitivity import export_sensitivity_atlas
+	from util.parallel import ParallelTrainer, benchmark_scaling
+
+	# Verify data directory exists
+	if not os.path.exists(args.data_dir):
+		print("Data directory \"%s\" does not exist" % args.data_dir)
+		sys.exit()
+
+	# Make model directory if it doesn't exist
+	if not os.path.exists(args.model_dir):
+		os.makedirs(args.model_dir)
+
+	# =====================
+	# Load/Preprocess Data:
+	# =====================
+
+	# Load training and testing partitions. These are copies (mmap=False), as
+	# standardize() works in place and Keras trains on whole arrays, but each set
+	# is gathered from features.npy once, as x[idx] did before.
+	(x_train, y_train), (x_test, y_test) = load_data(args.data_dir,
+		test_ratio=args.test_ratio, partition=args.partition, **partition_kwargs(args))
+
+	# Record the partition, which gives the order of latent.npy (for plot --labels)
+	save_model_partition(args.model_dir, args.data_dir, args.partition)
+
+	# Standardize
+	x_train, x_test = standardize(x_train, x_test)
+
+	# =============
+	# Build Models:
+	# =============
+
+	# Add an explicit channel dimension to our grayscale images so the data has
 	# shape (batch, height, width, channels)
-	x_train = np.reshape(x_train, x_train.shape + (1,))
-	x_test = np.reshape(x_test, x_test.shape + (1,))
-	encoder = build_encoder_cnn(
-		input_shape=x_train.shape[1:], 
-		latent_size=args.latent_size,
-		generative=args.gen)
-
-elif args.lstm:
+	if args.cnn:
+		x_train = np.reshape(x_train, x_train.shape + (1,))
+		x_test = np.reshape(x_test, x_test.shape + (1,))
+
 	# Transpose examples (Keras LSTMs have shape (example, timestep, feature))
-	x_train = np.swapaxes(x_train, 1, 2)
-	x_test = np.swapaxes(x_test, 1, 2)
-	encoder = build_encoder_lstm(
-		input_shape=x_train.shape[1:], 
-		latent_size=args.latent_size,
-		lstm_sizes=(128,),
-		generative=args.gen)
-
-# Build regressor and assemble end-to-end model
-regressor = build_regressor(
-	latent_size=args.latent_size, 
-	output_size=y_train.shape[1])
-model = build_end_to_end(encoder, regressor)
-
-
-# ===========
-# Train/Eval:
-# ===========
-
-# Train
-model.fit(x_train, y_train, epochs=args.epochs, batch_size=args.batch, shuffle=True)
-
-# Evaluate and export error plots
-model_eval(model, x_test, y_test, args.model_dir)
-
-# ===================
-# Export Keras Model:
-# ===================
-
-# Save models (Keras's JSON and H5 formats)
-export_keras(
-	model_dir=os.path.join(args.model_dir, 'keras'), 
-	model=model, 
-	encoder=encoder, 
-	regressor=regressor)
-
-# =======================
-# Export TimbreMap Model:
-# =======================
-
-# Encode and save latent space data
-latent = encoder.predict(np.append(x_train, x_test, axis=0))
-np.save(os.path.join(args.model_dir, 'latent'), latent)
-
-# Export the regressor model parameters
-p_dir = os.path.join(args.model_dir, 'timbremap')
-export_regressor(p_dir, regressor)
-
-# Export latent space means and variances
-if not args.pca:
-	export_vec_scale(p_dir, latent)
-	print("Testing (c -> z -> p) -> (p -> z -> c)");
-
-# Or perform PCA and export basis vectors and biases, plus re-oriented 
-# latent space statistics
-else:
-	weights, biases, latent_pca = pca(latent)
-	np.save(os.path.join(args.model_dir, 'latent_pca'), latent_pca)
-	export_vec_scale(p_dir, latent_pca)
-	export_pca_layer(p_dir, weights, biases)
-	print("Testing (c -> z' -> z -> p) -> (p -> z -> z' -> c)");
-
-# Verify forward and inverse mapping invertibility
-print("Error: %f" % test_max(p_dir))
-
-	
\ No newline at end of file
+	elif args.lstm:
+		x_train = np.swapaxes(x_train, 1, 2)
+		x_test = np.swapaxes(x_test, 1, 2)
+
+	# Build specified encoder model, regressor, and end-to-end model
+	spec = {
+		'encoder_type': 'dnn' if args.dnn else 'cnn' if args.cnn else 'lstm',
+		'input_shape': x_train.shape[1:],
+		'latent_size': args.latent_size,
+		'output_size': y_train.shape[1],
+		'generative': args.gen,
+	}
+	model, encoder, regressor = build_model(**spec)
+
+	# Measure data-parallel scaling only
+	if args.benchmark_workers:
+		benchmark_scaling(model, spec, x_train, y_train, args.benchmark_workers,
+			batch_size=args.batch,
+			sync_every=args.sync_every,
+			out_path=os.path.join(args.model_dir, 'scaling.json'))
+		return
+
+	# ===========
+	# Train/Eval:
+	# ===========
+
+	# Resume from the last checkpoint (the partition is stored, so the training
+	# and testing sets are the same as before)
+	ckpt_dir = os.path.join(args.model_dir, 'checkpoint')
+	state = None
+	if args.resume:
+		state = resume_training(ckpt_dir, model, encoder, regressor)
+	checkpoint = TrainingCheckpoint(ckpt_dir, encoder, regressor,
+		period=args.checkpoint_period,
+		patience=args.patience,
+		min_delta=args.min_delta,
+		state=state)
+
+	# Train, validating on the test set
+	if args.workers <= 1:
+		model.fit(x_train, y_train,
+			epochs=args.epochs,
+			batch_size=args.batch,
+			shuffle=True,
+			validation_data=(x_test, y_test),
+			initial_epoch=checkpoint.state['epoch'],
+			callbacks=[checkpoint])
+
+	# Train with worker processes, driving the checkpoint callback per epoch
+	else:
+		with ParallelTrainer(spec, x_train, y_train, args.workers,
+			batch_size=args.batch) as trainer:
+			checkpoint.set_model(model)
+			model.stop_training = False
+			# Start the workers from the (possibly resumed) optimizer state
+			model._make_train_function()
+			trainer.set_optimizer(model.optimizer.get_weights())
+			for epoch in range(checkpoint.state['epoch'], args.epochs):
+				loss = trainer.train_epoch(model, args.sync_every)
+				val_loss = 0.0
+				for i in range(0, len(x_test), args.eval_batch):
+					x, y = x_test[i:i + args.eval_batch], y_test[i:i + args.eval_batch]
+					val_loss += float(model.test_on_batch(x, y)) * len(x) / len(x_test)
+				print('Epoch %d/%d - loss: %.4f - val_loss: %.4f' % (
+					epoch + 1, args.epochs, loss, val_loss))
+				# Average the workers' optimizer states into the checkpointed model
+				trainer.gather_optimizer(model)
+				checkpoint.on_epoch_end(epoch, {'loss': loss, 'val_loss': val_loss})
+				if model.stop_training:
+					break
+			checkpoint.on_train_end()
+
+	# Evaluate and export error plots
+	model_eval(model, x_test, y_test, args.model_dir, batch_size=args.eval_batch)
+
+	# ===================
+	# Export Keras Model:
+	# ===================
+
+	# Save models (Keras's JSON and H5 formats)
+	export_keras(
+		model_dir=os.path.join(args.model_dir, 'keras'),
+		model=model,
+		encoder=encoder,
+		regressor=regressor)
+
+	# Export the encoder for numpy-only inference and verify it
+	enc_dir = os.path.join(args.model_dir, 'encoder')
+	export_encoder(os.path.join(args.model_dir, 'keras'), enc_dir)
+	print("Encoder export error: %f" % test_encoder(encoder, enc_dir, x_test))
+
+	# =======================
+	# Export TimbreMap Model:
+	# =======================
+
+	# Export the regressor model parameters (replacing any earlier export, whose
+	# layers would otherwise be loaded with the new ones)
+	p_dir = os.path.join(args.model_dir, 'timbremap')
+	if os.path.exists(p_dir):
+		shutil.rmtree(p_dir)
+	export_regressor(p_dir, regressor)
+
+	# Encode training and testing data in batches, writing latent.npy and
+	# exporting latent space statistics from the same pass. With PCA, also export
+	# basis vectors and biases, plus re-oriented latent space statistics.
+	export_latent(args.model_dir,
+		encode_batches(encoder.predict_on_batch, (x_train, x_test), args.eval_batch),
+		len(x_train) + len(x_test), use_pca=args.pca)
+	if not args.pca:
+		print("Testing (c -> z -> p) -> (p -> z -> c)");
+	else:
+		print("Testing (c -> z' -> z -> p) -> (p -> z -> z' -> c)");
+
+	# Verify forward and inverse mapping invertibility
+	print("Error: %f" % test_max(p_dir))
+
+	# Export the mapping's sensitivity atlas
+	export_sensitivity_atlas(p_dir)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Train TimbreMap models')
+	add_arguments(parser)
+	main(parser.parse_args())
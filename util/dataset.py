@@ -1,7 +1,7 @@
 import os
-import soundfile
+import json
+import zlib
 import numpy as np
-from natsort import natsorted
 
 # Feature Computation
 # ===================
@@ -11,6 +11,7 @@ from natsort import natsorted
 # return array will be standardized so that the width of every image is the 
 # median width across the dataset, unless specified. 
 def compute_features(wav_files, feature_func, equal_width=True):
+	import soundfile
 	features = []
 	n = len(wav_files)
 	# Load each wav example and compute its mel spectrogram
@@ -125,7 +126,208 @@ def standardize_groups(train_groups, test_groups):
 
 # 		return X, keras.utils.to_categorical(y, num_classes=self.n_classes)
 
-def load_data_varlen(data_dir, test_ratio=0.1):
+# Partitions
+# ==========
+#
+# Deterministic, index-based training/testing partitions. A partition is fully
+# specified by a small dict (method, seed, and method parameters), from which
+# its indices are regenerated with numpy's legacy RandomState, whose streams
+# are stable across numpy versions. Specs are stored by name in a single
+# manifest, 'partitions.json', in the data directory, along with the dataset
+# size and a checksum of the test indices to detect mismatches.
+#
+# Methods:
+#   'holdout':    random test_ratio of examples held out
+#   'kfold':      k random folds, holding out fold number 'fold'
+#   'stratified': as 'holdout' (or 'kfold' if k is given) within each stratum,
+#                 where strata are combinations of label columns 'columns'
+#                 binned into 'bins' equal ranges over 0-127
+#   'indices':    the explicit test set indices 'test' (e.g. imported from a
+#                 partition.npy saved before the manifest existed)
+PARTITION_METHODS = ('holdout', 'kfold', 'stratified', 'indices')
+
+# Partition spec for the given arguments (without the test set checksum)
+def partition_spec(n, method='holdout', seed=0, test_ratio=0.1, k=None, fold=0,
+	columns=(0,), bins=4, test=None):
+	if method not in PARTITION_METHODS:
+		raise ValueError('Unknown partition method \'%s\'' % method)
+	if method == 'kfold' and not k:
+		raise ValueError('k-fold partitions require k')
+	if method == 'indices':
+		if test is None:
+			raise ValueError('Index partitions require test indices')
+		return {'method': method, 'n': int(n), 'test': [int(i) for i in np.sort(test)]}
+	spec = {'method': method, 'seed': int(seed), 'n': int(n)}
+	if k:
+		spec.update(k=int(k), fold=int(fold))
+	else:
+		spec.update(test_ratio=float(test_ratio))
+	if method == 'stratified':
+		spec.update(columns=[int(c) for c in columns], bins=int(bins))
+	return spec
+
+class Partition:
+	def __init__(self, n, method='holdout', seed=0, test_ratio=0.1, k=None, fold=0,
+		columns=(0,), bins=4, labels=None, test=None):
+		if method == 'stratified' and labels is None:
+			raise ValueError('Stratified partitions require labels')
+		self.spec = partition_spec(n, method, seed, test_ratio, k, fold, columns, bins, test)
+		rs = np.random.RandomState(seed)
+		if method == 'indices':
+			groups = []
+		elif method == 'stratified':
+			# Stratum of each example, from its binned label values
+			y = np.asarray(labels)[:, list(columns)]
+			strata = np.zeros(n, dtype=np.int64)
+			for col in range(y.shape[1]):
+				strata = strata * bins + np.clip(y[:, col] * bins // 128, 0, bins - 1).astype(np.int64)
+			groups = [np.flatnonzero(strata == s) for s in np.unique(strata)]
+		else:
+			groups = [np.arange(n)]
+		test = [np.asarray(self.spec['test'], dtype=np.int64)] if method == 'indices' else []
+		for group in groups:
+			perm = group[rs.permutation(len(group))]
+			if k:
+				test.append(np.array_split(perm, k)[fold])
+			else:
+				test.append(perm[:int(round(len(perm) * test_ratio))])
+		self.test = np.sort(np.concatenate(test))
+		mask = np.ones(n, dtype=bool)
+		mask[self.test] = False
+		self.train = np.flatnonzero(mask)
+		self.spec['test_crc'] = zlib.crc32(self.test.astype(np.int64).tobytes())
+
+	@classmethod
+	def from_spec(cls, spec, labels=None):
+		kwargs = {key: val for key, val in spec.items() if key not in ('test_crc', 'request')}
+		partition = cls(labels=labels, **kwargs)
+		if 'test_crc' in spec and spec['test_crc'] != partition.spec['test_crc']:
+			raise ValueError('Partition %s does not reproduce its stored test set' % spec)
+		return partition
+
+	# Training and testing views (or copies) of arrays with one row per example
+	def apply(self, x, copy=False):
+		if copy:
+			return np.take(x, self.train, axis=0), np.take(x, self.test, axis=0)
+		return IndexedArray(x, self.train), IndexedArray(x, self.test)
+
+# Load partition 'name' from the manifest in data_dir, or create it with the
+# given arguments and add it to the manifest. A stored partition must have been
+# created with the same arguments. If legacy_file (a permutation saved by
+# earlier versions, e.g. 'partition.npy') exists in data_dir when a holdout
+# partition is first requested, its test set is imported as an 'indices'
+# partition, so existing data directories keep their test sets.
+def get_partition(data_dir, n, name='default', labels=None, legacy_file=None, **kwargs):
+	f_path = os.path.join(data_dir, 'partitions.json')
+	manifest = {}
+	if os.path.exists(f_path):
+		with open(f_path) as fh:
+			manifest = json.load(fh)
+	requested = partition_spec(n, **kwargs)
+	if name in manifest:
+		spec = manifest[name]
+		if spec['n'] != n:
+			raise ValueError('Partition \'%s\' is for %d examples, not %d' % (
+				name, spec['n'], n))
+		# Imported partitions store the arguments they were imported for
+		stored = spec.get('request',
+			{key: val for key, val in spec.items() if key != 'test_crc'})
+		if stored != requested:
+			raise ValueError('Partition \'%s\' in %s was created with %s, not %s '
+				'(use another partition name)' % (name, f_path, stored, requested))
+		return Partition.from_spec(spec, labels)
+	legacy_path = None if legacy_file is None else os.path.join(data_dir, legacy_file)
+	if legacy_path is not None and os.path.exists(legacy_path) and \
+		requested['method'] == 'holdout':
+		perm = np.load(legacy_path)
+		if len(perm) != n:
+			raise ValueError('%s is for %d examples, not %d' % (legacy_path, len(perm), n))
+		partition = Partition(n, 'indices',
+			test=perm[:int(round(n * requested['test_ratio']))])
+		partition.spec['request'] = requested
+		print('Imported %s as partition \'%s\'' % (legacy_path, name))
+	else:
+		partition = Partition(n, labels=labels, **kwargs)
+	manifest[name] = partition.spec
+	with open(f_path, 'w') as fh:
+		json.dump(manifest, fh, indent=1, sort_keys=True)
+	return partition
+
+# Test set ratio of models trained before partitions were recorded (train.py
+# always used load_data()'s default)
+LEGACY_TEST_RATIO = 0.1
+
+# Record partition 'name' of data_dir in model_dir/partition.json, so the order
+# of the model's latent vectors is known if the data directory's manifest changes
+# later. Datasets concatenated from sub-directories have no single partition, so
+# nothing is recorded (and any earlier record is removed).
+def save_model_partition(model_dir, data_dir, name='default'):
+	record_path = os.path.join(model_dir, 'partition.json')
+	f_path = os.path.join(data_dir, 'partitions.json')
+	manifest = {}
+	if os.path.exists(f_path):
+		with open(f_path) as fh:
+			manifest = json.load(fh)
+	if name not in manifest:
+		if os.path.exists(record_path):
+			os.remove(record_path)
+		return
+	with open(record_path, 'w') as fh:
+		json.dump({'name': name, 'spec': manifest[name]}, fh, indent=1, sort_keys=True)
+
+# Labels of data_dir (labels.npy or labels.csv) in the order train.py encoded
+# them to model_dir/latent.npy: the training set, then the testing set, of the
+# partition recorded in model_dir/partition.json. Models without a record were
+# trained on the permutation in data_dir/partition.npy, with its first
+# LEGACY_TEST_RATIO as the testing set. Otherwise the order of the latent vectors
+# is unknown, so raises ValueError unless file_order is True, in which case
+# labels are returned in file order.
+def load_labels(data_dir, model_dir, file_order=False):
+	try:
+		y = np.load(os.path.join(data_dir, 'labels.npy'))
+	except FileNotFoundError:
+		y = np.loadtxt(os.path.join(data_dir, 'labels.csv'), delimiter=',')
+	record_path = os.path.join(model_dir, 'partition.json')
+	legacy_path = os.path.join(data_dir, 'partition.npy')
+	if os.path.exists(record_path):
+		with open(record_path) as fh:
+			spec = json.load(fh)['spec']
+		if spec['n'] != len(y):
+			raise ValueError('%s is for %d examples, not %d' % (record_path, spec['n'], len(y)))
+		p = Partition.from_spec(spec, y)
+		return np.concatenate(p.apply(y, copy=True))
+	if os.path.exists(legacy_path):
+		perm = np.load(legacy_path)
+		if len(perm) != len(y):
+			raise ValueError('%s is for %d examples, not %d' % (legacy_path, len(perm), len(y)))
+		n_test = int(round(len(perm) * LEGACY_TEST_RATIO))
+		return np.concatenate((y[perm[n_test:]], y[perm[:n_test]]))
+	if not file_order:
+		raise ValueError('Neither %s nor %s exists, so the order of the latent vectors '
+			'is unknown' % (record_path, legacy_path))
+	return y
+
+# Lazy view of the rows idx of an array (e.g. a memory-mapped features.npy).
+# Rows are only read when indexed, one batch at a time; np.asarray() copies
+# the whole view.
+class IndexedArray:
+	def __init__(self, x, idx):
+		self._x = x
+		self._idx = np.asarray(idx)
+		self.shape = (len(self._idx),) + x.shape[1:]
+		self.dtype = x.dtype
+		self.ndim = x.ndim
+	def __len__(self):
+		return len(self._idx)
+	def __getitem__(self, key):
+		if isinstance(key, tuple):
+			return self._x[(self._idx[key[0]],) + key[1:]]
+		return self._x[self._idx[key]]
+	def __array__(self, dtype=None, copy=None):
+		x = np.take(self._x, self._idx, axis=0)
+		return x if dtype is None else x.astype(dtype)
+
+def load_data_varlen(data_dir, test_ratio=0.1, partition='default', **kwargs):
 	group = 0
 	train_groups = list()
 	test_groups = list()
@@ -133,29 +335,23 @@ def load_data_varlen(data_dir, test_ratio=0.1):
 		try:
 			x = np.load(os.path.join(data_dir, 'features_%d.npy' % group))
 			y = np.load(os.path.join(data_dir, 'labels_%d.npy' % group))
-			n = len(x)
-			n_test = round(n * test_ratio)
 
-			# Load an existing partition 
-			try:
-				p = np.load(os.path.join(data_dir, 'partition_%d.npy' % group))
-			
-			# Or generate and save a new one
-			except FileNotFoundError:
-				p = np.random.permutation(n)
-				np.save(os.path.join(data_dir, 'partition_%d.npy' % group), p)
-			
-			# Partitioned training and testing sets
-			x_train = x[p[n_test:]]
-			y_train = y[p[n_test:]]
-			x_test = x[p[:n_test]]
-			y_test = y[p[:n_test]]
+			# Partitioned training and testing sets (one manifest entry per group)
+			p = get_partition(data_dir, len(x), '%s_group_%d' % (partition, group),
+				labels=y, test_ratio=test_ratio,
+				legacy_file='partition_%d.npy' % group if partition == 'default' else None,
+				**kwargs)
+			x_train, x_test = p.apply(x, copy=True)
+			y_train, y_test = p.apply(y, copy=True)
 			print("loaded group %d" % group)
 
 			train_groups.append((x_train, y_train))
 			test_groups.append((x_test, y_test))
 			group += 1
 
+		# Partition mismatches
+		except ValueError:
+			raise
 		except:
 			print("failed to load group %d" % group)
 			break
@@ -167,35 +363,30 @@ def load_data_varlen(data_dir, test_ratio=0.1):
 # ========
 #
 # Returns dataset partitions (x_train, y_train), (x_test, y_test) by loading from
-# the specified directory containing 'features.npy' and 'labels.npy'. Generates a
-# new partition if none exists (as 'partition.npy'). If features and labels numpy
+# the specified directory containing 'features.npy' and 'labels.npy'. Uses the
+# partition named 'partition' in the directory's manifest, or creates it from
+# test_ratio and any other Partition arguments (e.g. seed, method, k, fold). If
+# mmap is True, features are memory-mapped and returned as IndexedArray views,
+# without copying the training and testing sets (read-only, so they can't be
+# standardized in place; train.py loads copies). If features and labels numpy
 # arrays are not found in the provided directory, recursively searches sub-
 # directories and attempts to concatenate features (by padding image widths to the
 # width of the images in the largest dataset) and labels (assuming the number of
 # labels is the same in all sub-directories).
-def load_data(data_dir, test_ratio=0.1):
+def load_data(data_dir, test_ratio=0.1, partition='default', mmap=False, **kwargs):
 	# Try loading features from the provided directory
 	try:
-		x = np.load(os.path.join(data_dir, 'features.npy'))
+		x = np.load(os.path.join(data_dir, 'features.npy'), mmap_mode='r' if mmap else None)
 
 		try:
 			y = np.load(os.path.join(data_dir, 'labels.npy'))
 		except:
 			y = np.loadtxt(os.path.join(data_dir, 'labels.csv'), delimiter=',')  
-		n = len(x)
-		n_test = round(n * test_ratio)
-		# Load an existing partition 
-		try:
-			p = np.load(os.path.join(data_dir, 'partition.npy'))
-		# Or generate and save a new one
-		except FileNotFoundError:
-			p = np.random.permutation(n)
-			np.save(os.path.join(data_dir, 'partition.npy'), p)
 		# Return partitioned training and testing sets
-		x_train = x[p[n_test:]]
-		y_train = y[p[n_test:]]
-		x_test = x[p[:n_test]]
-		y_test = y[p[:n_test]]
+		p = get_partition(data_dir, len(x), partition, labels=y, test_ratio=test_ratio,
+			legacy_file='partition.npy' if partition == 'default' else None, **kwargs)
+		x_train, x_test = p.apply(x, copy=not mmap)
+		y_train, y_test = p.apply(y, copy=True)
 		print('load_data(\'%s\')' % data_dir) 	# Print if successful
 
 	# If the provided directory contains no features, check its sub-directories
@@ -205,11 +396,14 @@ def load_data(data_dir, test_ratio=0.1):
 		x_tr, y_tr, x_te, y_te = ([], [], [], [])
 		for d in os.listdir(data_dir):
 			try:
-				(x_train, y_train), (x_test, y_test) = load_data(os.path.join(data_dir, d))
+				(x_train, y_train), (x_test, y_test) = load_data(os.path.join(data_dir, d),
+					test_ratio, partition, **kwargs)
 				x_tr.extend(x_train)
 				y_tr.extend(y_train)
 				x_te.extend(x_test)
 				y_te.extend(y_test)
+			except ValueError:
+				raise
 			except:
 				pass
 		# Standardize image widths to that of the widest dataset and return		
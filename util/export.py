@@ -0,0 +1,247 @@
+import os
+import json
+import shutil
+import numpy as np
+
+# Exporting to Max/MSP
+# ====================
+# Exports regressor, pca, and latent space scaling parameters to plain text in a set
+# of directories parsed by the Max external 'timbremap' and its C classes 'dense_layer'
+# 'pca_layer', and 'vec_scale'. Only requires numpy, so runtime models can be
+# (re-)exported without importing Keras.
+#
+# Export latent space statistics, from a latent array or LatentStats
+def export_vec_scale(out_dir, latent):
+	out_dir = os.path.join(out_dir, 'vec_scale')
+	if not os.path.exists(out_dir):
+		os.makedirs(out_dir)
+	if not isinstance(latent, LatentStats):
+		latent = LatentStats(latent)
+	# Export min, range, mean, and std. dev. of test data projected into latent space
+	export_matrix(os.path.join(out_dir, 'min'), latent.min)
+	export_matrix(os.path.join(out_dir, 'range'), latent.max - latent.min)
+	export_matrix(os.path.join(out_dir, 'mean'), latent.mean)
+	export_matrix(os.path.join(out_dir, 'std'), latent.std)
+
+def export_pca_layer(out_dir, weights, biases):
+	out_dir = os.path.join(out_dir, 'pca_layer')
+	if not os.path.exists(out_dir):
+		os.makedirs(out_dir)
+	export_layer(out_dir, weights, biases)
+
+# Export regressor layers
+def export_regressor(out_dir, regressor):
+	for idx, layer in enumerate(regressor.layers[1:]):
+		if layer.get_weights():
+			export_layer(os.path.join(out_dir, 'dense_layer_%d' % idx),
+					layer.get_weights()[0],
+					layer.get_weights()[1],
+					layer.activation)
+
+# Export a dense_layer. The activation may be given by name or as a Keras
+# activation function.
+def export_layer(out_dir, weights, biases, activation_func=None):
+	if not os.path.exists(out_dir):
+		os.makedirs(out_dir)
+	try:	# Inverse
+		weights_inv = np.linalg.inv(weights)
+	except:	# Pseudoinverse
+		weights_inv = np.linalg.pinv(weights)
+	# Export weights and biases
+	export_matrix(os.path.join(out_dir, 'weights'), weights)
+	export_matrix(os.path.join(out_dir, 'biases'), biases)
+	export_matrix(os.path.join(out_dir, 'weights_inv'), weights_inv)
+	# Export Activation
+	act_str = getattr(activation_func, '__name__', activation_func)
+	if act_str not in ('sigmoid', 'tanh'):
+		return
+	with open(os.path.join(out_dir, 'activation'), 'w') as fh:
+		fh.write(act_str)
+		fh.write('\n')
+
+# Write flattened matrix values
+def export_matrix(f_path, np_arr):
+	fh = open(f_path, 'w')
+	for val in np_arr.flatten():
+		fh.write('%.32f\n' % val)
+	fh.close()
+	np.save(f_path, np_arr)
+
+# PCA
+# ===
+#
+# Principal components of the latent space, matching sklearn's PCA (full SVD,
+# with signs chosen so the largest loading of each left singular vector is
+# positive). Returns basis vectors as columns, biases, and the projected latent.
+def pca(latent):
+	biases = latent.mean(0)
+	u, s, vt = np.linalg.svd(latent - biases, full_matrices=False)
+	signs = np.sign(u[np.argmax(np.abs(u), axis=0), range(u.shape[1])])
+	weights = (vt * signs[:, np.newaxis]).T
+	return weights, biases, np.dot(latent - biases, weights)
+
+# Principal components from streamed LatentStats: eigenvectors of the latent
+# covariance, by decreasing variance, with signs chosen so the largest loading of
+# each component is positive. Returns basis vectors as columns and biases. These
+# signs are provisional: export_latent_scaling() re-orients the components as
+# sklearn's PCA (and pca()) once the projections are known.
+def pca_stats(stats):
+	var, vecs = np.linalg.eigh(stats.cov)
+	vecs = vecs[:, np.argsort(var)[::-1]]
+	signs = np.sign(vecs[np.argmax(np.abs(vecs), axis=0), range(vecs.shape[1])])
+	return vecs * signs, stats.mean
+
+# Streaming latent statistics
+# ===========================
+#
+# Running count, min, max, mean, and co-moments of latent vectors, updated a
+# batch at a time (merging batch statistics as in Chan et al.'s parallel
+# variance algorithm), so the full latent array never needs to be in memory.
+class LatentStats:
+	def __init__(self, latent=None):
+		self.n = 0
+		if latent is not None:
+			self.update(latent)
+	def update(self, z):
+		z = np.asarray(z, dtype=np.float64)
+		n_b = len(z)
+		if not n_b:
+			return
+		mean_b = z.mean(0)
+		dz = z - mean_b
+		com_b = np.dot(dz.T, dz)
+		if self.n == 0:
+			self.n, self.min, self.max = n_b, z.min(0), z.max(0)
+			self.mean, self._com = mean_b, com_b
+			return
+		n = self.n + n_b
+		delta = mean_b - self.mean
+		self.mean = self.mean + delta * (n_b / n)
+		self._com = self._com + com_b + np.outer(delta, delta) * (self.n * n_b / n)
+		self.min = np.minimum(self.min, z.min(0))
+		self.max = np.maximum(self.max, z.max(0))
+		self.n = n
+	# Statistics of z * signs, for signs of +/-1 (e.g. flipped principal components)
+	def flip(self, signs):
+		self.min, self.max = (np.where(signs < 0, -self.max, self.min),
+			np.where(signs < 0, -self.min, self.max))
+		self.mean = self.mean * signs
+		self._com = self._com * np.outer(signs, signs)
+	@property
+	def cov(self):
+		return self._com / self.n
+	@property
+	def std(self):
+		return np.sqrt(np.diag(self.cov))
+
+# Encode each array in xs (e.g. training and testing sets) in batches with the
+# function encode, yielding latent batches
+def encode_batches(encode, xs, batch_size=1024):
+	for x in xs:
+		for start in range(0, len(x), batch_size):
+			yield encode(np.asarray(x[start:start + batch_size]))
+
+# Write n latent vectors from batches to model_dir/latent.npy through a memmap,
+# and export the latent space scaling (and PCA) to model_dir/timbremap, all
+# from a single pass over the batches. Returns the timbremap directory.
+def export_latent(model_dir, batches, n, use_pca=False):
+	stats = LatentStats()
+	latent = None
+	start = 0
+	for z in batches:
+		if latent is None:
+			latent = np.lib.format.open_memmap(os.path.join(model_dir, 'latent.npy'),
+				mode='w+', dtype=z.dtype, shape=(n, z.shape[1]))
+		latent[start:start + len(z)] = z
+		stats.update(z)
+		start += len(z)
+	latent.flush()
+	return export_latent_scaling(model_dir, latent, use_pca, stats)
+
+# Export the latent space scaling (and PCA) for the latent array (which may be
+# memory-mapped) to p_dir (model_dir/timbremap by default), in batches. With PCA,
+# the projected latent is written to model_dir/latent_pca.npy through a memmap.
+# Without, any earlier PCA layer and latent_pca.npy are removed, so neither the
+# runtime nor a later export_model() picks them up.
+def export_latent_scaling(model_dir, latent, use_pca=False, stats=None, batch_size=65536,
+	p_dir=None):
+	if p_dir is None:
+		p_dir = os.path.join(model_dir, 'timbremap')
+	if stats is None:
+		stats = LatentStats()
+		for start in range(0, len(latent), batch_size):
+			stats.update(latent[start:start + batch_size])
+	if not use_pca:
+		export_vec_scale(p_dir, stats)
+		if os.path.exists(os.path.join(p_dir, 'pca_layer')):
+			shutil.rmtree(os.path.join(p_dir, 'pca_layer'))
+		if os.path.exists(os.path.join(model_dir, 'latent_pca.npy')):
+			os.remove(os.path.join(model_dir, 'latent_pca.npy'))
+		return p_dir
+	weights, biases = pca_stats(stats)
+	latent_pca = np.lib.format.open_memmap(os.path.join(model_dir, 'latent_pca.npy'),
+		mode='w+', dtype=latent.dtype, shape=latent.shape)
+	stats_pca = LatentStats()
+	for start in range(0, len(latent), batch_size):
+		z = np.dot(latent[start:start + batch_size] - biases, weights)
+		latent_pca[start:start + len(z)] = z
+		stats_pca.update(z)
+	# Orient components as sklearn's PCA (and pca()), with the largest magnitude
+	# projection on each component positive, so re-exported models keep the
+	# orientation of models exported with sklearn
+	signs = np.where(stats_pca.max >= -stats_pca.min, 1.0, -1.0)
+	if np.any(signs < 0):
+		weights = weights * signs
+		for start in range(0, len(latent), batch_size):
+			latent_pca[start:start + batch_size] *= signs
+		stats_pca.flip(signs)
+	latent_pca.flush()
+	export_vec_scale(p_dir, stats_pca)
+	export_pca_layer(p_dir, weights, biases)
+	return p_dir
+
+# Re-exporting saved models
+# =========================
+#
+# Rebuild model_dir/timbremap from the regressor saved in model_dir/keras and the
+# latent space data in model_dir/latent.npy, without Keras. PCA is used if
+# use_pca is True, or if None and the model has a saved latent_pca.npy.
+#
+# The model is built in timbremap.tmp and then swapped in, so no layer of an
+# earlier export (a PCA layer, extra dense layers, an activation, or a
+# sensitivity atlas) survives into the new one.
+def export_model(model_dir, use_pca=None):
+	p_dir = os.path.join(model_dir, 'timbremap')
+	tmp_dir = p_dir + '.tmp'
+	if os.path.exists(tmp_dir):
+		shutil.rmtree(tmp_dir)
+	export_regressor_h5(tmp_dir, os.path.join(model_dir, 'keras'))
+	latent = np.load(os.path.join(model_dir, 'latent.npy'), mmap_mode='r')
+	if use_pca is None:
+		use_pca = os.path.exists(os.path.join(model_dir, 'latent_pca.npy'))
+	export_latent_scaling(model_dir, latent, use_pca, p_dir=tmp_dir)
+	old_dir = p_dir + '.old'
+	if os.path.exists(old_dir):
+		shutil.rmtree(old_dir)
+	if os.path.exists(p_dir):
+		os.rename(p_dir, old_dir)
+	os.rename(tmp_dir, p_dir)
+	if os.path.exists(old_dir):
+		shutil.rmtree(old_dir)
+	return p_dir
+
+# Export regressor layers from regressor.json and regressor.h5 in keras_dir,
+# numbered as in export_regressor()
+def export_regressor_h5(out_dir, keras_dir):
+	import h5py
+	with open(os.path.join(keras_dir, 'regressor.json')) as jf:
+		layers = json.load(jf)['config']['layers']
+	with h5py.File(os.path.join(keras_dir, 'regressor.h5'), 'r') as h5:
+		for idx, layer in enumerate(layers[1:]):
+			group = h5[layer['config']['name']]
+			w_names = group.attrs['weight_names']
+			if len(w_names):
+				export_layer(os.path.join(out_dir, 'dense_layer_%d' % idx),
+					np.array(group[w_names[0]]),
+					np.array(group[w_names[1]]),
+					layer['config'].get('activation'))
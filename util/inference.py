@@ -0,0 +1,212 @@
+import os
+import json
+import numpy as np
+
+# Numpy Encoder Inference
+# =======================
+#
+# Exports encoders built by the build_encoder_* functions (in util.models) from
+# their saved Keras JSON and H5 files to a directory of plain weight arrays, and
+# runs them forward with numpy only, so encoding processes don't need to import
+# Keras/TensorFlow. An exported encoder directory contains a 'layers' file
+# listing the trunk layer directories in order, one directory per trunk layer
+# ('type' and 'activation' files, plus .npy weights), and a head directory for
+# the latent space ('latent', or 'latent_mean' and 'latent_log_var' for
+# generative encoders).
+
+# Layers with no inference-time effect on the latent mean
+SKIP_LAYERS = ('InputLayer', 'Dropout', 'KLDivergenceLayer', 'Lambda',
+	'Multiply', 'Add')
+
+# Latent space layer names used by build_encoder_* and build_latent_generative
+HEAD_LAYERS = ('latent', 'latent_mean', 'latent_log_var')
+
+# Exporting
+# =========
+#
+# Export the encoder saved by export_keras() in keras_dir (encoder.json and
+# encoder.h5) to out_dir. Reads the H5 weights directly, so Keras isn't needed.
+def export_encoder(keras_dir, out_dir):
+	import h5py
+	with open(os.path.join(keras_dir, 'encoder.json')) as jf:
+		config = json.load(jf)
+	layers = config['config']['layers']
+	if not os.path.exists(out_dir):
+		os.makedirs(out_dir)
+	trunk = []
+	with h5py.File(os.path.join(keras_dir, 'encoder.h5'), 'r') as h5:
+		for layer in layers:
+			cls = layer['class_name']
+			cfg = layer['config']
+			if cls in SKIP_LAYERS:
+				continue
+			if cls not in ('Dense', 'Conv2D', 'LSTM', 'Flatten', 'RepeatVector'):
+				raise ValueError('Unsupported encoder layer %s (%s)' % (cls, cfg['name']))
+			# Head layers are stored by name, trunk layers by position
+			if cls == 'Dense' and cfg['name'] in HEAD_LAYERS:
+				layer_dir = os.path.join(out_dir, cfg['name'])
+			else:
+				layer_dir = os.path.join(out_dir, 'layer_%d' % len(trunk))
+				trunk.append(os.path.basename(layer_dir))
+			export_encoder_layer(layer_dir, cls, cfg, h5)
+	write_lines(os.path.join(out_dir, 'layers'), trunk)
+
+# Export a single layer's type, configuration, and weights
+def export_encoder_layer(layer_dir, cls, cfg, h5):
+	if not os.path.exists(layer_dir):
+		os.makedirs(layer_dir)
+	write_lines(os.path.join(layer_dir, 'type'), [cls])
+	if 'activation' in cfg:
+		write_lines(os.path.join(layer_dir, 'activation'), [cfg['activation']])
+	if cls == 'LSTM':
+		write_lines(os.path.join(layer_dir, 'recurrent_activation'),
+			[cfg['recurrent_activation']])
+	elif cls == 'Conv2D':
+		if cfg['padding'] != 'valid' or tuple(cfg['strides']) != (1, 1):
+			raise ValueError('Only valid, unit-stride Conv2D layers are supported')
+	elif cls == 'RepeatVector':
+		write_lines(os.path.join(layer_dir, 'n'), [str(cfg['n'])])
+	# Weights are stored as 'layer_name/weight_name:0'
+	group = h5[cfg['name']]
+	for w_name in group.attrs['weight_names']:
+		if isinstance(w_name, bytes):
+			w_name = w_name.decode('utf8')
+		f_name = w_name.split('/')[-1].split(':')[0]
+		np.save(os.path.join(layer_dir, f_name), np.array(group[w_name]))
+
+def write_lines(f_path, lines):
+	with open(f_path, 'w') as fh:
+		for line in lines:
+			fh.write(line + '\n')
+
+def read_lines(f_path):
+	with open(f_path) as fh:
+		return [line.rstrip('\n') for line in fh if line.strip()]
+
+# Inference
+# =========
+#
+# Activation functions by Keras name
+ACTIVATIONS = {
+	'linear': lambda x: x,
+	'relu': lambda x: np.maximum(x, 0, out=x),
+	'tanh': lambda x: np.tanh(x, out=x),
+	'sigmoid': lambda x: np.divide(1, 1 + np.exp(-x, out=x), out=x),
+	'hard_sigmoid': lambda x: np.clip(0.2 * x + 0.5, 0, 1),
+}
+
+# Numpy forward implementation of an exported encoder. Inputs should be
+# preprocessed exactly as for the Keras encoder (standardized, and reshaped or
+# transposed for CNN and LSTM encoders).
+class NumpyEncoder:
+	def __init__(self, enc_dir, dtype=np.float32):
+		self._dtype = dtype
+		self._layers = [load_encoder_layer(os.path.join(enc_dir, d), dtype)
+			for d in read_lines(os.path.join(enc_dir, 'layers'))]
+		if os.path.exists(os.path.join(enc_dir, 'latent_mean')):
+			self._mean = load_encoder_layer(os.path.join(enc_dir, 'latent_mean'), dtype)
+			self._log_var = load_encoder_layer(os.path.join(enc_dir, 'latent_log_var'), dtype)
+			self.generative = True
+		else:
+			self._mean = load_encoder_layer(os.path.join(enc_dir, 'latent'), dtype)
+			self._log_var = None
+			self.generative = False
+		self.latent_size = self._mean._b.shape[0]
+	# Encode a batch, returning the latent mean, or a sample from the latent
+	# distribution of a generative encoder if sample=True
+	def process_forward(self, inputs, sample=False):
+		patch = np.asarray(inputs, dtype=self._dtype)
+		for layer in self._layers:
+			patch = layer.process_forward(patch)
+		latent = self._mean.process_forward(patch)
+		if sample and self.generative:
+			std = np.exp(0.5 * self._log_var.process_forward(patch))
+			latent += std * np.random.normal(0, 1, latent.shape)
+		return latent
+	# Encode in batches of batch_size to bound memory (e.g. for memory-mapped x)
+	def predict(self, x, batch_size=256, sample=False):
+		latent = np.zeros((len(x), self.latent_size), dtype=self._dtype)
+		for start in range(0, len(x), batch_size):
+			stop = min(start + batch_size, len(x))
+			latent[start:stop] = self.process_forward(x[start:stop], sample)
+		return latent
+
+def load_encoder_layer(layer_dir, dtype=np.float32):
+	cls = read_lines(os.path.join(layer_dir, 'type'))[0]
+	return {
+		'Dense': NumpyDense,
+		'Conv2D': NumpyConv2D,
+		'LSTM': NumpyLSTM,
+		'Flatten': NumpyFlatten,
+		'RepeatVector': NumpyRepeatVector,
+	}[cls](layer_dir, dtype)
+
+def load_weight(layer_dir, name, dtype):
+	return np.load(os.path.join(layer_dir, name + '.npy')).astype(dtype)
+
+def load_activation(layer_dir, name='activation'):
+	try:
+		return ACTIVATIONS[read_lines(os.path.join(layer_dir, name))[0]]
+	except FileNotFoundError:
+		return ACTIVATIONS['linear']
+
+class NumpyDense:
+	def __init__(self, layer_dir, dtype):
+		self._w = load_weight(layer_dir, 'kernel', dtype)
+		self._b = load_weight(layer_dir, 'bias', dtype)
+		self._act = load_activation(layer_dir)
+	def process_forward(self, inputs):
+		return self._act(np.dot(inputs, self._w) + self._b)
+
+# Valid padding, unit stride, channels last
+class NumpyConv2D:
+	def __init__(self, layer_dir, dtype):
+		self._w = load_weight(layer_dir, 'kernel', dtype)	# (kh, kw, c_in, c_out)
+		self._b = load_weight(layer_dir, 'bias', dtype)
+		self._act = load_activation(layer_dir)
+	def process_forward(self, inputs):
+		n, h, w, c = inputs.shape
+		kh, kw = self._w.shape[:2]
+		s = inputs.strides
+		# View of all (kh, kw, c) patches without copying
+		patches = np.lib.stride_tricks.as_strided(inputs,
+			shape=(n, h - kh + 1, w - kw + 1, kh, kw, c),
+			strides=(s[0], s[1], s[2], s[1], s[2], s[3]))
+		return self._act(np.tensordot(patches, self._w, axes=3) + self._b)
+
+# Returns the final hidden state (return_sequences=False)
+class NumpyLSTM:
+	def __init__(self, layer_dir, dtype):
+		self._w = load_weight(layer_dir, 'kernel', dtype)
+		self._u = load_weight(layer_dir, 'recurrent_kernel', dtype)
+		self._b = load_weight(layer_dir, 'bias', dtype)
+		self._act = load_activation(layer_dir)
+		self._rec_act = load_activation(layer_dir, 'recurrent_activation')
+		self._units = self._u.shape[0]
+	def process_forward(self, inputs):
+		n, t, _ = inputs.shape
+		u = self._units
+		# Input contributions to all gates for every time step at once
+		x_proj = np.dot(inputs, self._w) + self._b
+		h = np.zeros((n, u), dtype=x_proj.dtype)
+		c = np.zeros((n, u), dtype=x_proj.dtype)
+		for step in range(t):
+			z = x_proj[:, step] + np.dot(h, self._u)
+			i = self._rec_act(z[:, :u])				# Gate order i, f, c, o
+			f = self._rec_act(z[:, u:2*u])
+			o = self._rec_act(z[:, 3*u:])
+			c = f * c + i * self._act(z[:, 2*u:3*u])
+			h = o * self._act(c.copy())
+		return h
+
+class NumpyFlatten:
+	def __init__(self, layer_dir, dtype):
+		return
+	def process_forward(self, inputs):
+		return inputs.reshape((len(inputs), -1))
+
+class NumpyRepeatVector:
+	def __init__(self, layer_dir, dtype):
+		self._n = int(read_lines(os.path.join(layer_dir, 'n'))[0])
+	def process_forward(self, inputs):
+		return np.repeat(inputs[:, np.newaxis, :], self._n, axis=1)
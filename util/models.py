@@ -1,14 +1,19 @@
 import os
+import shutil
+import json
 import numpy as np
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
 from keras import regularizers
 from keras import losses
 from keras import backend as K
 from keras.models import Model
 from keras.layers import *
 from keras.activations import sigmoid, tanh
-from sklearn.decomposition import PCA
+from keras.callbacks import Callback
+from util.inference import NumpyEncoder
+from util.plots import error_plots
+# Exporters and PCA (numpy-only) kept importable from here
+from util.export import export_vec_scale, export_pca_layer, export_regressor, \
+	export_layer, export_matrix, pca
 
 # Encoders
 # ========
@@ -143,11 +148,14 @@ def build_regressor(latent_size, output_size, dense_sizes=()):
 # End-to-end Model
 # ================
 #
-# Assemble end-to-end model from encoder and regressor, compile, and test
-def build_end_to_end(encoder, regressor):
+# Assemble end-to-end model from encoder and regressor, compile, and test (unless
+# verbose is False)
+def build_end_to_end(encoder, regressor, verbose=True):
 	# End-to-end model 
 	model = Model(encoder.inputs, regressor(encoder(encoder.inputs)), name='model')
 	model.compile(loss='mse', optimizer='rmsprop')
+	if not verbose:
+		return model
 	# Print summaries
 	encoder.summary()
 	regressor.summary()
@@ -167,19 +175,206 @@ def build_end_to_end(encoder, regressor):
 	# assert sum(sum(p == p_h)) == p.size, "Incorrect encoder/regressor configuration"
 	return model
 
+# Build the default configuration of an encoder ('dnn', 'cnn', or 'lstm') and
+# regressor for preprocessed inputs of shape input_shape (with the channel
+# dimension for CNNs, and transposed for LSTMs), as used by train.py. Returns
+# the end-to-end model, encoder, and regressor.
+def build_model(encoder_type, input_shape, latent_size, output_size, generative,
+	verbose=True):
+	if encoder_type == 'dnn':
+		numel = int(np.prod(input_shape))
+		encoder = build_encoder_dnn(
+			input_shape=input_shape,
+			latent_size=latent_size,
+			dense_sizes=(numel//4, numel//16),
+			generative=generative)
+	elif encoder_type == 'cnn':
+		encoder = build_encoder_cnn(
+			input_shape=input_shape,
+			latent_size=latent_size,
+			generative=generative)
+	elif encoder_type == 'lstm':
+		encoder = build_encoder_lstm(
+			input_shape=input_shape,
+			latent_size=latent_size,
+			lstm_sizes=(128,),
+			generative=generative)
+	else:
+		raise ValueError('Unknown encoder type \'%s\'' % encoder_type)
+	regressor = build_regressor(
+		latent_size=latent_size,
+		output_size=output_size)
+	model = build_end_to_end(encoder, regressor, verbose)
+	return model, encoder, regressor
+
+# Checkpointing
+# =============
+#
+# Saves encoder and regressor weights, optimizer state, and training progress
+# to ckpt_dir every 'period' epochs, so training can be resumed with
+# resume_training(). If patience is given, stops training when the validation
+# loss hasn't improved by min_delta for that many epochs, and restores the
+# weights of the best epoch.
+#
+# Each checkpoint's files are written to a directory of their own, epoch_<N>
+# (and best_<N> for the best epoch's weights), which is renamed into place once
+# complete. state.json is then replaced, committing the checkpoint, and only
+# then are directories it no longer refers to removed. An interruption at any
+# point leaves state.json and the directories it refers to consistent.
+class TrainingCheckpoint(Callback):
+	def __init__(self, ckpt_dir, encoder, regressor, period=1, patience=None,
+		min_delta=0.0, state=None):
+		super(TrainingCheckpoint, self).__init__()
+		self._dir = ckpt_dir
+		self._encoder = encoder
+		self._regressor = regressor
+		self._period = period
+		self._patience = patience
+		self._min_delta = min_delta
+		self.state = state or {'epoch': 0, 'best': None, 'best_epoch': None, 'wait': 0}
+		self._saved_epoch = self.state['epoch'] if state else None
+		if not os.path.exists(ckpt_dir):
+			os.makedirs(ckpt_dir)
+
+	def on_epoch_end(self, epoch, logs=None):
+		logs = logs or {}
+		self.state['epoch'] = epoch + 1
+		val_loss = logs.get('val_loss')
+		if val_loss is not None:
+			best = self.state['best']
+			if best is None or val_loss < best - self._min_delta:
+				self.state.update(best=float(val_loss), best_epoch=epoch + 1, wait=0)
+				self.write_dir('best_%d' % (epoch + 1), optimizer=False)
+			else:
+				self.state['wait'] += 1
+		stop = self._patience is not None and self.state['wait'] >= self._patience
+		if stop or (epoch + 1) % self._period == 0:
+			self.save()
+		if stop:
+			print('Early stopping after epoch %d (best epoch %d, val_loss %f)' % (
+				epoch + 1, self.state['best_epoch'], self.state['best']))
+			self.model.stop_training = True
+
+	def on_train_end(self, logs=None):
+		self.save()
+		if self._patience is not None and self.state['best_epoch'] is not None:
+			best_dir = os.path.join(self._dir, 'best_%d' % self.state['best_epoch'])
+			self._encoder.load_weights(os.path.join(best_dir, 'encoder.h5'))
+			self._regressor.load_weights(os.path.join(best_dir, 'regressor.h5'))
+
+	# Write weights, optimizer state, and progress, then remove directories of
+	# earlier checkpoints
+	def save(self):
+		name = 'epoch_%d' % self.state['epoch']
+		if self._saved_epoch != self.state['epoch']:
+			self.write_dir(name)
+			self._saved_epoch = self.state['epoch']
+		tmp = os.path.join(self._dir, 'state.tmp.json')
+		with open(tmp, 'w') as fh:
+			json.dump(self.state, fh, indent=1)
+		os.replace(tmp, os.path.join(self._dir, 'state.json'))
+		keep = {name}
+		if self.state['best_epoch'] is not None:
+			keep.add('best_%d' % self.state['best_epoch'])
+		for entry in os.listdir(self._dir):
+			if entry.startswith(('epoch_', 'best_')) and entry not in keep:
+				shutil.rmtree(os.path.join(self._dir, entry))
+
+	# Write weights (and optimizer state) to ckpt_dir/name, through name.tmp
+	def write_dir(self, name, optimizer=True):
+		out_dir = os.path.join(self._dir, name)
+		tmp = out_dir + '.tmp'
+		if os.path.exists(tmp):
+			shutil.rmtree(tmp)
+		os.makedirs(tmp)
+		self._encoder.save_weights(os.path.join(tmp, 'encoder.h5'))
+		self._regressor.save_weights(os.path.join(tmp, 'regressor.h5'))
+		if optimizer:
+			np.savez(os.path.join(tmp, 'optimizer.npz'), *self.model.optimizer.get_weights())
+		if os.path.exists(out_dir):
+			shutil.rmtree(out_dir)
+		os.rename(tmp, out_dir)
+
+# Load the last checkpoint in ckpt_dir into a freshly built (and compiled)
+# end-to-end model. Returns the checkpoint state (with the epoch to resume
+# from), or None if there is no checkpoint.
+def resume_training(ckpt_dir, model, encoder, regressor):
+	try:
+		with open(os.path.join(ckpt_dir, 'state.json')) as fh:
+			state = json.load(fh)
+	except FileNotFoundError:
+		return None
+	last_dir = os.path.join(ckpt_dir, 'epoch_%d' % state['epoch'])
+	encoder.load_weights(os.path.join(last_dir, 'encoder.h5'))
+	regressor.load_weights(os.path.join(last_dir, 'regressor.h5'))
+	# Optimizer weights only exist once the training function is built
+	model._make_train_function()
+	with np.load(os.path.join(last_dir, 'optimizer.npz')) as f:
+		weights = [f['arr_%d' % i] for i in range(len(f.files))]
+	if weights:
+		model.optimizer.set_weights(weights)
+	else:
+		print('Warning: checkpoint has no optimizer state; the optimizer restarts')
+	print('Resuming from epoch %d' % state['epoch'])
+	return state
+
 # Evaluation
 # ==========
 # 
-def model_eval(model, x_test, y_test, model_dir=None, file_suffix=None):
-	# Eval
-	score = model.evaluate(x_test, y_test, batch_size=len(x_test))
+# Evaluate in chunks of batch_size examples, streaming predictions into a
+# preallocated array and accumulating per-parameter errors, so memory is bounded
+# by the batch size (x_test may be an IndexedArray view of memory-mapped
+# features). Writes metrics to model_dir/metrics.json and error distribution
+# plots if a directory is provided. Returns the metrics.
+def model_eval(model, x_test, y_test, model_dir=None, file_suffix=None, batch_size=256):
+	n, m = y_test.shape
+	y_hat = np.zeros((n, m), dtype=np.float32)
+	errors = RunningErrors(m)
+	score = 0.0
+	for start in range(0, n, batch_size):
+		stop = min(start + batch_size, n)
+		x = np.asarray(x_test[start:stop])
+		y = y_test[start:stop]
+		# Loss averaged over batches, weighted by batch size
+		score += float(model.test_on_batch(x, y)) * (stop - start) / n
+		y_hat[start:stop] = model.predict_on_batch(x)
+		errors.update(y, np.round(y_hat[start:stop]))
+	metrics = errors.metrics()
+	metrics['score'] = score
 	print('Score: %f' % score)
-	# Predictions
-	y_hat = model.predict(x_test, batch_size=len(x_test), verbose=1, steps=None)
-	print(np.concatenate((y_test, np.round(y_hat)), axis=1))
-	# Export error distribution plots if a directory is provided
+	print('MAE:  ' + ' '.join('%7.3f' % e for e in metrics['mae']))
+	print('RMSE: ' + ' '.join('%7.3f' % e for e in metrics['rmse']))
+	# Export metrics and error distribution plots if a directory is provided
 	if model_dir is not None:
+		fname = 'metrics'
+		if file_suffix is not None:
+			fname += file_suffix
+		with open(os.path.join(model_dir, fname + '.json'), 'w') as fh:
+			json.dump(metrics, fh, indent=1)
 		error_plots(y_test, np.round(y_hat), model_dir, file_suffix=file_suffix)
+	return metrics
+
+# Running per-parameter mean absolute and root mean squared errors
+class RunningErrors:
+	def __init__(self, n_params):
+		self._n = 0
+		self._abs = np.zeros(n_params)
+		self._sq = np.zeros(n_params)
+	def update(self, y, y_hat):
+		err = np.asarray(y, dtype=np.float64) - y_hat
+		self._n += len(err)
+		self._abs += np.abs(err).sum(0)
+		self._sq += (err * err).sum(0)
+	def metrics(self):
+		mae = self._abs / max(self._n, 1)
+		rmse = np.sqrt(self._sq / max(self._n, 1))
+		return {
+			'n': self._n,
+			'mae': mae.tolist(),
+			'rmse': rmse.tolist(),
+			'mae_mean': float(mae.mean()),
+			'rmse_mean': float(rmse.mean()),
+		}
 
 def model_eval_varlen(model, x_test, y_test, model_dir=None, file_suffix=None):
 	# Eval
@@ -191,75 +386,6 @@ def model_eval_varlen(model, x_test, y_test, model_dir=None, file_suffix=None):
 		y_hat[i,:] = model.predict(x.reshape((1,) + x.shape), batch_size=1, verbose=1, steps=None)
 	return score, y_hat
 
-# Produce matrix of error distribution plots for each target
-def error_plots(y, y_hat, path, file_suffix=None):
-	n, m = y.shape
-	for i in range(m):
-		bin, err, err_abs = errs(y, y_hat, i)	# Error dist. over i^th variable values
-		try:
-			w = np.diff(bin)[0] / 2 				# Plot's bar width
-		except:
-			w = np.diff(bin) / 2
-		min_err = np.min(err)
-		max_err = np.max(err_abs)
-		for j in range(m):
-			ax = plt.subplot(m, m, i*m + j+1)
-			b1 = ax.bar(bin-w/2, err[:, j], w, color='r')
-			b2 = ax.bar(bin+w/2, err_abs[:, j], w, color='b')
-			ax.set_ylim(bottom=min_err, top=max_err)
-			ax.set_xlabel('Value P%d' % i)	
-			ax.set_ylabel('Test Error P%d' % j)
-			ax.legend((b1, b2), ('error', 'abs_error'))
-	plt.ioff()
-	fig = plt.gcf()
-	dpi = 110
-	fig.set_size_inches((1440/dpi, 900/dpi))
-	fname = 'err_dist'
-	if file_suffix is not None:
-		fname += file_suffix
-	plt.savefig(os.path.join(path, fname + '.png'), bbox_inches='tight', dpi=dpi)
-	plt.close(fig)
-
-# Helper function for err_plots(); computes a single error distribution
-def errs(y, y_hat, idx_indep):
-	n, m = y.shape 						# n examples, m parameters
-	y_indep = y[:, idx_indep]	 		# Indep. variable for err distribution
-	bin = np.unique(y_indep)			# Distribution bins
-	err = np.zeros((len(bin), m)) 		# Error (signed)
-	err_abs = np.zeros((len(bin), m))	# Absolute error
-	for i in range(n):			
-		# Distribution bin for this value of indep. variable
-		b = np.where(bin == y_indep[i])[0][0]
-		for j in range(m):
-			# Err and abs. err
-			e = y[i, j] - y_hat[i, j]
-			err[b][j] += e
-			err_abs[b][j] += abs(e)
-	return bin, err, err_abs
-
-
-# PCA and plotting
-# ================
-# 
-def pca(latent):
-	pca = PCA(n_components=latent.shape[1])
-	latent_projected = pca.fit_transform(latent)
-	weights = pca.components_.T
-	biases = pca.mean_
-	return weights, biases, latent_projected
-
-def scatter_latent(z, z_projected=None):
-	fig = plt.figure()
-	if z_projected is not None:
-		ax1 = fig.add_subplot(121, projection='3d')
-		ax2 = fig.add_subplot(122, projection='3d')
-		ax1.scatter(z[:,0], z[:,1], z[:,2])
-		ax2.scatter(z_projected[:,0], z_projected[:,1], z_projected[:,2])
-	else:
-		ax = fig.add_subplot(111, projection='3d')
-		ax.scatter(z[:,0], z[:,1], z[:,2])
-	plt.show()
-
 # Exporting Keras models
 # ======================
 # 
@@ -281,65 +407,14 @@ def export_keras(model_dir, model, encoder, regressor):
 	regressor.save_weights(os.path.join(model_dir, 'regressor.h5'))
 	model.save_weights(os.path.join(model_dir, 'model.h5'))
 
-# Exporting to Max/MSP 
-# ====================
-# Exports regressor, pca, and latent space scaling parameters to plain text in a set
-# of directories parsed by the Max external 'timbremap' and its C classes 'dense_layer'
-# 'pca_layer', and 'vec_scale'. 
-#
-# Export latent space statistics
-def export_vec_scale(out_dir, latent):
-	out_dir = os.path.join(out_dir, 'vec_scale')
-	if not os.path.exists(out_dir):
-		os.makedirs(out_dir)
-	# Export min, range, mean, and std. dev. of test data projected into latent space
-	export_matrix(os.path.join(out_dir, 'min'), latent.min(0))
-	export_matrix(os.path.join(out_dir, 'range'), latent.max(0) - latent.min(0))
-	export_matrix(os.path.join(out_dir, 'mean'), latent.mean(0))
-	export_matrix(os.path.join(out_dir, 'std'), latent.std(0))
-
-def export_pca_layer(out_dir, weights, biases):
-	out_dir = os.path.join(out_dir, 'pca_layer')
-	if not os.path.exists(out_dir):
-		os.makedirs(out_dir)
-	export_layer(out_dir, weights, biases)
-
-# Export regressor layers
-def export_regressor(out_dir, regressor):
-	for idx, layer in enumerate(regressor.layers[1:]):
-		if layer.get_weights():
-			export_layer(os.path.join(out_dir, 'dense_layer_%d' % idx),
-					layer.get_weights()[0],
-					layer.get_weights()[1],
-					layer.activation)
-
-# Export a dense_layer 
-def export_layer(out_dir, weights, biases, activation_func=None):
-	if not os.path.exists(out_dir):
-		os.makedirs(out_dir)
-	try:	# Inverse 
-		weights_inv = np.linalg.inv(weights)	
-	except:	# Pseudoinverse
-		weights_inv = np.linalg.pinv(weights)	
-	# Export weights and biases
-	export_matrix(os.path.join(out_dir, 'weights'), weights)
-	export_matrix(os.path.join(out_dir, 'biases'), biases)
-	export_matrix(os.path.join(out_dir, 'weights_inv'), weights_inv)
-	# Export Activation
-	if activation_func == sigmoid:		
-		act_str = 'sigmoid'
-	elif activation_func == tanh:
-		act_str = 'tanh'
-	else:
-		return
-	fh = open(os.path.join(out_dir, 'activation'), 'w')
-	fh.write(act_str)
-	fh.write('\n')
-
-# Write flattened matrix values
-def export_matrix(f_path, np_arr):
-	fh = open(f_path, 'w')
-	for val in np_arr.flatten():
-		fh.write('%.32f\n' % val)
-	fh.close()
-	np.save(f_path, np_arr)
\ No newline at end of file
+# Verify an encoder exported by export_encoder() (in util.inference) against
+# encoder.predict. Generative encoders are compared on their latent mean, since
+# encoder.predict samples the latent distribution. Returns max. absolute error.
+def test_encoder(encoder, enc_dir, x, batch_size=256):
+	try:
+		encoder = Model(encoder.inputs[0], encoder.get_layer('latent_mean').output)
+	except ValueError:
+		pass
+	z = encoder.predict(x, batch_size=batch_size)
+	z_hat = NumpyEncoder(enc_dir).predict(x, batch_size=batch_size)
+	return np.max(np.abs(z - z_hat))
@@ -0,0 +1,206 @@
+import os
+import time
+import shutil
+import tempfile
+import json
+import traceback
+import multiprocessing
+import numpy as np
+
+# Data-parallel Training
+# ======================
+#
+# Trains an end-to-end model (as built by build_model() in util.models) with
+# several worker processes on the local machine. The training set is written
+# once to a .npy file that every worker memory-maps, and each worker trains its
+# own copy of the model on a fixed shard of the examples. Every 'sync_every'
+# batches, the workers' weights are averaged (weighted by the number of examples
+# each trained on) and broadcast back, so all workers continue from the same
+# weights. Averaging weights rather than gradients keeps Keras's optimizers
+# unchanged; each worker keeps its own optimizer state. With sync_every=1 and
+# plain SGD this is equivalent to averaging gradients. For checkpoints, the
+# workers' optimizer states are averaged into the model's optimizer with
+# gather_optimizer(), and set_optimizer() starts every worker from a (resumed)
+# optimizer state.
+#
+# The shared training data is written to a temporary directory (in work_dir,
+# if given), which is removed by close().
+#
+# Workers are started with the 'spawn' method, since TensorFlow isn't fork-safe,
+# and each is limited to its share of the CPU cores.
+
+class ParallelTrainer:
+	def __init__(self, spec, x, y, n_workers, work_dir=None, batch_size=32, threads=None,
+		seed=0):
+		self.n_workers = n_workers
+		self.n = len(x)
+		self.batch_size = batch_size
+		if threads is None:
+			threads = max(1, multiprocessing.cpu_count() // n_workers)
+		# Shared training data
+		if work_dir is not None and not os.path.exists(work_dir):
+			os.makedirs(work_dir)
+		self._data_dir = tempfile.mkdtemp(prefix='timbremap_', dir=work_dir)
+		self._conns = []
+		self._procs = []
+		x_path = os.path.join(self._data_dir, 'x_train.npy')
+		y_path = os.path.join(self._data_dir, 'y_train.npy')
+		np.save(x_path, x)
+		np.save(y_path, y)
+		shards = np.array_split(np.random.RandomState(seed).permutation(self.n), n_workers)
+		# Start workers
+		ctx = multiprocessing.get_context('spawn')
+		for idx, shard in enumerate(shards):
+			conn, child_conn = ctx.Pipe()
+			proc = ctx.Process(target=worker_main, args=(child_conn, spec, x_path, y_path,
+				np.sort(shard), batch_size, threads, seed + idx + 1), daemon=True)
+			proc.start()
+			self._conns.append(conn)
+			self._procs.append(proc)
+		self._gather()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	# Train every worker for 'steps' batches from the model's current weights,
+	# then set the model to the averaged weights. Returns the number of examples
+	# trained on and the mean loss.
+	def train_round(self, model, steps):
+		weights = model.get_weights()
+		for conn in self._conns:
+			conn.send(('train', weights, steps))
+		results = self._gather()
+		n = sum(r[1] for r in results)
+		model.set_weights([
+			sum(r[0][i] * (r[1] / n) for r in results) for i in range(len(weights))])
+		return n, sum(r[2] * r[1] for r in results) / n
+
+	# Train for one pass over the training set (in total across workers),
+	# synchronizing every sync_every batches. Returns the mean loss.
+	def train_epoch(self, model, sync_every=1):
+		steps = int(np.ceil(self.n / (self.n_workers * self.batch_size)))
+		total, loss = 0, 0.0
+		for start in range(0, steps, sync_every):
+			n, round_loss = self.train_round(model, min(sync_every, steps - start))
+			total += n
+			loss += round_loss * n
+		return loss / total
+
+	# Set the model's optimizer state to the average of the workers' (the
+	# model's training function must be built)
+	def gather_optimizer(self, model):
+		for conn in self._conns:
+			conn.send(('get_optimizer', None, 0))
+		results = self._gather()
+		model.optimizer.set_weights([
+			np.mean([r[i] for r in results], axis=0).astype(results[0][i].dtype)
+			for i in range(len(results[0]))])
+
+	# Set every worker's optimizer state
+	def set_optimizer(self, weights):
+		for conn in self._conns:
+			conn.send(('set_optimizer', weights, 0))
+		self._gather()
+
+	def close(self):
+		for conn in self._conns:
+			try:
+				conn.send(('stop', None, 0))
+			except (BrokenPipeError, EOFError):
+				pass
+		for proc in self._procs:
+			proc.join()
+		self._conns = []
+		self._procs = []
+		if self._data_dir is not None:
+			shutil.rmtree(self._data_dir, ignore_errors=True)
+			self._data_dir = None
+
+	def _gather(self):
+		results = []
+		for conn in self._conns:
+			status, result = conn.recv()
+			if status == 'error':
+				self.close()
+				raise RuntimeError('Training worker failed:\n' + result)
+			results.append(result)
+		return results
+
+def worker_main(conn, spec, x_path, y_path, shard, batch_size, threads, seed):
+	try:
+		import tensorflow as tf
+		from keras import backend as K
+		K.set_session(tf.Session(config=tf.ConfigProto(
+			intra_op_parallelism_threads=threads,
+			inter_op_parallelism_threads=1)))
+		from util.models import build_model
+		model, _, _ = build_model(verbose=False, **spec)
+		# Build the training function, so the optimizer state exists
+		model._make_train_function()
+		# Copy this worker's shard out of the shared training set
+		x = np.load(x_path, mmap_mode='r')[shard]
+		y = np.load(y_path, mmap_mode='r')[shard]
+		rs = np.random.RandomState(seed)
+		order = rs.permutation(len(shard))
+		pos = 0
+		conn.send(('ready', None))
+		while True:
+			msg, weights, steps = conn.recv()
+			if msg == 'stop':
+				break
+			if msg == 'get_optimizer':
+				conn.send(('done', model.optimizer.get_weights()))
+				continue
+			if msg == 'set_optimizer':
+				model.optimizer.set_weights(weights)
+				conn.send(('done', None))
+				continue
+			model.set_weights(weights)
+			n, loss = 0, 0.0
+			for _ in range(steps):
+				# Reshuffle after every pass over the shard
+				if pos >= len(order):
+					order = rs.permutation(len(shard))
+					pos = 0
+				idx = order[pos:pos + batch_size]
+				pos += batch_size
+				loss += float(model.train_on_batch(x[idx], y[idx])) * len(idx)
+				n += len(idx)
+			conn.send(('done', (model.get_weights(), n, loss / max(n, 1))))
+	except Exception:
+		conn.send(('error', traceback.format_exc()))
+
+# Scaling benchmark
+# =================
+#
+# Measure training throughput (examples per second, including synchronization)
+# for each number of workers in worker_counts, over 'rounds' rounds of
+# sync_every batches per worker after one warm-up round. Prints a table and, if
+# out_path is given, writes the results to it as JSON.
+def benchmark_scaling(model, spec, x, y, worker_counts, work_dir=None, batch_size=32,
+	sync_every=10, rounds=5, out_path=None):
+	results = []
+	initial = model.get_weights()
+	for n_workers in worker_counts:
+		model.set_weights(initial)
+		with ParallelTrainer(spec, x, y, n_workers, work_dir, batch_size) as trainer:
+			trainer.train_round(model, 1)
+			t = time.time()
+			n = sum(trainer.train_round(model, sync_every)[0] for _ in range(rounds))
+			t = time.time() - t
+		results.append({'workers': n_workers, 'examples': n, 'seconds': t,
+			'examples_per_sec': n / t})
+	model.set_weights(initial)
+	base = results[0]['examples_per_sec'] / results[0]['workers']
+	print('workers  examples/s  speedup  efficiency')
+	for r in results:
+		r['efficiency'] = r['examples_per_sec'] / (base * r['workers'])
+		print('%7d  %10.1f  %7.2f  %10.2f' % (r['workers'], r['examples_per_sec'],
+			r['examples_per_sec'] / results[0]['examples_per_sec'], r['efficiency']))
+	if out_path is not None:
+		with open(out_path, 'w') as fh:
+			json.dump(results, fh, indent=1)
+	return results
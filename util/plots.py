@@ -0,0 +1,159 @@
+import os
+import numpy as np
+import matplotlib.pyplot as plt
+
+# Plotting
+# ========
+#
+# Produce matrix of error distribution plots for each target
+def error_plots(y, y_hat, path, file_suffix=None):
+	n, m = y.shape
+	for i in range(m):
+		bin, err, err_abs = errs(y, y_hat, i)	# Error dist. over i^th variable values
+		try:
+			w = np.diff(bin)[0] / 2 				# Plot's bar width
+		except:
+			w = np.diff(bin) / 2
+		min_err = np.min(err)
+		max_err = np.max(err_abs)
+		for j in range(m):
+			ax = plt.subplot(m, m, i*m + j+1)
+			b1 = ax.bar(bin-w/2, err[:, j], w, color='r')
+			b2 = ax.bar(bin+w/2, err_abs[:, j], w, color='b')
+			ax.set_ylim(bottom=min_err, top=max_err)
+			ax.set_xlabel('Value P%d' % i)	
+			ax.set_ylabel('Test Error P%d' % j)
+			ax.legend((b1, b2), ('error', 'abs_error'))
+	plt.ioff()
+	fig = plt.gcf()
+	dpi = 110
+	fig.set_size_inches((1440/dpi, 900/dpi))
+	fname = 'err_dist'
+	if file_suffix is not None:
+		fname += file_suffix
+	plt.savefig(os.path.join(path, fname + '.png'), bbox_inches='tight', dpi=dpi)
+	plt.close(fig)
+
+# Helper function for err_plots(); computes a single error distribution
+def errs(y, y_hat, idx_indep):
+	n, m = y.shape 						# n examples, m parameters
+	y_indep = y[:, idx_indep]	 		# Indep. variable for err distribution
+	bin = np.unique(y_indep)			# Distribution bins
+	err = np.zeros((len(bin), m)) 		# Error (signed)
+	err_abs = np.zeros((len(bin), m))	# Absolute error
+	for i in range(n):			
+		# Distribution bin for this value of indep. variable
+		b = np.where(bin == y_indep[i])[0][0]
+		for j in range(m):
+			# Err and abs. err
+			e = y[i, j] - y_hat[i, j]
+			err[b][j] += e
+			err_abs[b][j] += abs(e)
+	return bin, err, err_abs
+
+# Interactive 3-D scatter of latent vectors z (and optionally their PCA
+# projection), showing at most max_points randomly chosen points
+def scatter_latent(z, z_projected=None, max_points=None):
+	from mpl_toolkits.mplot3d import Axes3D		# Registers '3d' projection
+	if max_points is not None and len(z) > max_points:
+		idx = np.sort(np.random.RandomState(0).choice(len(z), max_points, replace=False))
+		z = z[idx]
+		if z_projected is not None:
+			z_projected = z_projected[idx]
+	fig = plt.figure()
+	if z_projected is not None:
+		ax1 = fig.add_subplot(121, projection='3d')
+		ax2 = fig.add_subplot(122, projection='3d')
+		ax1.scatter(z[:,0], z[:,1], z[:,2])
+		ax2.scatter(z_projected[:,0], z_projected[:,1], z_projected[:,2])
+	else:
+		ax = fig.add_subplot(111, projection='3d')
+		ax.scatter(z[:,0], z[:,1], z[:,2])
+	plt.show()
+
+# Latent space density plots
+# ==========================
+#
+# Headless alternative to scatter_latent() for large latent sets. Latent vectors
+# are binned with numpy (in batches, so z may be memory-mapped) into 2-D
+# histograms over each pair of latent dimensions, drawn as images, and a 3-D
+# histogram, drawn as one scatter of its occupied voxels, so drawing time doesn't
+# depend on the number of points. If labels are given (one row per latent
+# vector), bins are colored by the mean value of label column 'param', with
+# opacity from the bin's density; otherwise by density alone. The figure is
+# rendered with the Agg canvas and written to f_path, without pyplot or a
+# display.
+def plot_latent_density(f_path, z, labels=None, param=0, bins=64, bins_3d=16, title=None,
+	batch_size=65536):
+	from matplotlib.figure import Figure
+	from matplotlib.backends.backend_agg import FigureCanvasAgg
+	from matplotlib.cm import ScalarMappable
+	from matplotlib.colors import Normalize
+	from mpl_toolkits.mplot3d import Axes3D		# Registers '3d' projection
+	if labels is not None and len(labels) != len(z):
+		raise ValueError('%d labels for %d latent vectors' % (len(labels), len(z)))
+	d = z.shape[1]
+	lo, hi = np.min(z, axis=0), np.max(z, axis=0)
+	hi = np.where(hi > lo, hi, lo + 1)
+	pairs = [(i, j) for i in range(d) for j in range(i + 1, d)]
+	counts, sums = latent_histograms(z, labels, param, bins, lo, hi, pairs, batch_size)
+	cmap = plt.get_cmap('viridis')
+	norm = Normalize(0, 127)
+	fig = Figure(figsize=(4 * (len(pairs) + (d == 3)), 4))
+	FigureCanvasAgg(fig)
+	for k, (i, j) in enumerate(pairs):
+		ax = fig.add_subplot(1, len(pairs) + (d == 3), k + 1)
+		rgba = density_colors(counts[k], sums[k], cmap, norm)
+		ax.imshow(np.swapaxes(rgba, 0, 1), origin='lower', aspect='auto', interpolation='nearest',
+			extent=(lo[i], hi[i], lo[j], hi[j]))
+		ax.set_xlabel('z%d' % i)
+		ax.set_ylabel('z%d' % j)
+	if d == 3:
+		count, total = latent_histograms(z, labels, param, bins_3d, lo, hi,
+			[(0, 1, 2)], batch_size)
+		rgba = density_colors(count[0], total[0], cmap, norm)
+		occupied = count[0] > 0
+		centers = [lo[i] + (np.arange(bins_3d) + 0.5) * (hi[i] - lo[i]) / bins_3d
+			for i in range(3)]
+		xyz = np.meshgrid(*centers, indexing='ij')
+		ax = fig.add_subplot(1, len(pairs) + 1, len(pairs) + 1, projection='3d')
+		ax.scatter(*[c[occupied] for c in xyz], c=rgba[occupied], s=20, depthshade=False)
+		ax.set_xlabel('z0')
+		ax.set_ylabel('z1')
+		ax.set_zlabel('z2')
+	if labels is not None:
+		mappable = ScalarMappable(norm, cmap)
+		mappable.set_array([])		# Required by matplotlib 3.0
+		fig.colorbar(mappable, ax=fig.axes, label='P%d' % param)
+	if title is not None:
+		fig.suptitle(title)
+	fig.savefig(f_path, dpi=100)
+
+# Histograms of z over each tuple of latent dimensions in dims, with 'bins' bins
+# per dimension over [lo, hi], and of the sums of label column 'param' (or None
+# without labels). Returns lists of count and sum histograms.
+def latent_histograms(z, labels, param, bins, lo, hi, dims, batch_size=65536):
+	counts = [0] * len(dims)
+	sums = [0 if labels is not None else None] * len(dims)
+	for start in range(0, len(z), batch_size):
+		batch = np.asarray(z[start:start + batch_size])
+		if labels is not None:
+			values = np.asarray(labels[start:start + batch_size])[:, param]
+		for k, dim in enumerate(dims):
+			rng = [(lo[i], hi[i]) for i in dim]
+			counts[k] = counts[k] + np.histogramdd(batch[:, dim], bins, rng)[0]
+			if labels is not None:
+				sums[k] = sums[k] + np.histogramdd(batch[:, dim], bins, rng, weights=values)[0]
+	return counts, sums
+
+# RGBA colors for histogram bins: the mean label value (or log density, without
+# labels) through cmap, with opacity from log density, and empty bins clear
+def density_colors(count, total, cmap, norm):
+	density = np.log1p(count) / np.log1p(max(count.max(), 1))
+	if total is None:
+		rgba = cmap(density)
+	else:
+		rgba = cmap(norm(total / np.maximum(count, 1)))
+		rgba[..., 3] = 0.2 + 0.8 * density
+	rgba[count == 0] = 0
+	return rgba
@@ -0,0 +1,326 @@
+import os
+import numpy as np
+from util.tests import MaxVecScale, MaxPCALayer, MaxDenseLayer
+
+# Fixed-point Runtime Models
+# ==========================
+#
+# Quantizes an exported timbremap model (vec_scale, pca_layer, dense_layer_*) to
+# 8 or 16-bit fixed point for hosts without FPU headroom. Every tensor and every
+# intermediate vector gets its own number of fractional bits (a power-of-two
+# scale), so the runtime only needs integer multiplies, adds, and shifts. The
+# sigmoid output activation and its inverse become lookup tables yielding MIDI
+# values 0-127 directly; a linear output layer yields fixed-point values in its
+# out_frac format instead. Intermediate formats are calibrated on a grid over the
+# control space; since every layer before the output activation is linear, the
+# grid's corners bound the calibrated ranges exactly.
+#
+# A quantized model directory mirrors the float one, with integer values in the
+# text and .npy files, a '<name>_frac' file for each tensor, and 'in_frac' and
+# 'out_frac' files for each layer's input and output vectors.
+
+QUANTIZE_BITS = (8, 16)
+
+# Pre-activations beyond +/-PRE_CLIP give 127*sigmoid(x) that rounds to 0 or 127
+PRE_CLIP = 6.0
+
+# Maximum number of index bits of the sigmoid lookup table
+LUT_BITS = 10
+
+# Fixed-point helpers
+# ===================
+#
+def qmax(bits):
+	return 2**(bits - 1) - 1
+
+def int_dtype(bits):
+	return np.int8 if bits == 8 else np.int16
+
+# Fractional bits that fit +/-absmax in a signed word
+def frac_bits(absmax, bits):
+	if absmax == 0:
+		return bits - 1
+	return int(np.floor(np.log2(qmax(bits) / absmax)))
+
+def to_fixed(x, frac, bits):
+	return np.clip(np.round(np.asarray(x) * 2.0**frac), -qmax(bits), qmax(bits)).astype(np.int64)
+
+def to_float(x, frac):
+	return x * 2.0**-frac
+
+# Multiply by 2^-n with rounding (arithmetic shift right, or left if n < 0)
+def shift(x, n):
+	if n > 0:
+		return (x + (1 << (n - 1))) >> n
+	return x << -n
+
+def saturate(x, bits):
+	return np.clip(x, -qmax(bits), qmax(bits))
+
+# Exporting
+# =========
+#
+# Quantize the float timbremap model in p_dir to out_dir. Returns out_dir.
+def quantize_model(p_dir, out_dir, bits=8, n_calib=5):
+	if bits not in QUANTIZE_BITS:
+		raise ValueError('Quantization supports %s bits, not %d' % (QUANTIZE_BITS, bits))
+	scale, pca_layer, dense_layers, acts = load_float_layers(p_dir)
+
+	# Calibrate intermediate vector ranges on a grid including the corners
+	rng = np.linspace(0, 1, n_calib)
+	c = np.array(np.meshgrid(*[rng] * len(scale._bias))).reshape((len(scale._bias), -1)).T
+	z_scaled = scale.process_forward(c)
+	patch = z_scaled
+	if pca_layer is not None:
+		patch = pca_layer.process_forward(patch)
+	z = patch
+
+	if not os.path.exists(out_dir):
+		os.makedirs(out_dir)
+	write_int(os.path.join(out_dir, 'bits'), bits)
+
+	# Scaling layer: c (in [0, 1]) -> z*
+	c_frac = bits - 1
+	zs_frac = frac_bits(np.abs(z_scaled).max(), bits)
+	inv_range = 1.0 / scale._scale
+	layer_dir = os.path.join(out_dir, 'vec_scale')
+	export_fixed(layer_dir, 'range', scale._scale, bits)
+	export_fixed(layer_dir, 'inv_range', inv_range, bits)
+	export_fixed(layer_dir, 'min', scale._bias, bits, frac=zs_frac)
+	write_int(os.path.join(layer_dir, 'in_frac'), c_frac)
+	write_int(os.path.join(layer_dir, 'out_frac'), zs_frac)
+
+	# PCA layer: z* -> z
+	in_frac = zs_frac
+	if pca_layer is not None:
+		z_frac = frac_bits(np.abs(z).max(), bits)
+		layer_dir = os.path.join(out_dir, 'pca_layer')
+		export_fixed(layer_dir, 'weights', pca_layer._w, bits)
+		export_fixed(layer_dir, 'weights_inv', pca_layer._wi, bits)
+		export_fixed(layer_dir, 'biases', pca_layer._b, bits, frac=z_frac)
+		write_int(os.path.join(layer_dir, 'in_frac'), in_frac)
+		write_int(os.path.join(layer_dir, 'out_frac'), z_frac)
+		in_frac = z_frac
+
+	# Dense layer(s): z -> p
+	patch = z
+	for idx, (layer, act) in enumerate(zip(dense_layers, acts)):
+		pre = np.dot(patch, layer._w) + layer._b
+		if act == 'sigmoid':
+			out_frac = frac_bits(PRE_CLIP, bits)
+		elif act == 'linear':
+			out_frac = frac_bits(np.abs(pre).max(), bits)
+		else:
+			raise ValueError('Quantization doesn\'t support %s activations' % act)
+		layer_dir = os.path.join(out_dir, 'dense_layer_%d' % idx)
+		export_fixed(layer_dir, 'weights', layer._w, bits)
+		export_fixed(layer_dir, 'weights_inv', layer._wi, bits)
+		export_fixed(layer_dir, 'biases', layer._b, bits, frac=out_frac)
+		write_int(os.path.join(layer_dir, 'in_frac'), in_frac)
+		write_int(os.path.join(layer_dir, 'out_frac'), out_frac)
+		if act == 'sigmoid':
+			export_sigmoid_luts(layer_dir, out_frac, bits)
+		patch = layer.process_forward(patch)
+		in_frac = out_frac
+	return out_dir
+
+# Sigmoid (scaled to 127) table indexed by shift(pre + clip, lut_shift), and its
+# inverse indexed by MIDI value
+def export_sigmoid_luts(layer_dir, pre_frac, bits):
+	clip = int(round(PRE_CLIP * 2**pre_frac))
+	lut_shift = max(0, int(np.ceil(np.log2(2 * clip + 1))) - LUT_BITS)
+	n = shift(2 * clip, lut_shift) + 1
+	pre = ((np.arange(n) << lut_shift) - clip) * 2.0**-pre_frac
+	lut = np.round(127.0 / (1 + np.exp(-pre))).astype(np.uint8)
+	# Inverse at MIDI 0 and 127 is unbounded, so clip to the forward table's range
+	p = np.clip(np.arange(128), 0.5, 126.5) / 127.0
+	lut_inv = np.clip(np.round(np.log(p / (1 - p)) * 2**pre_frac), -clip, clip)
+	export_int_matrix(os.path.join(layer_dir, 'lut'), lut)
+	export_int_matrix(os.path.join(layer_dir, 'lut_inv'), lut_inv.astype(int_dtype(bits)))
+	write_int(os.path.join(layer_dir, 'lut_shift'), lut_shift)
+	write_int(os.path.join(layer_dir, 'lut_clip'), clip)
+
+# Quantize a tensor to its own fractional bits (if frac isn't given) and export
+def export_fixed(layer_dir, name, x, bits, frac=None):
+	if not os.path.exists(layer_dir):
+		os.makedirs(layer_dir)
+	if frac is None:
+		frac = frac_bits(np.abs(x).max(), bits)
+	export_int_matrix(os.path.join(layer_dir, name), to_fixed(x, frac, bits).astype(int_dtype(bits)))
+	write_int(os.path.join(layer_dir, name + '_frac'), frac)
+
+# Write flattened integer matrix values (as export_matrix() in util.export)
+def export_int_matrix(f_path, np_arr):
+	with open(f_path, 'w') as fh:
+		for val in np_arr.flatten():
+			fh.write('%d\n' % val)
+	np.save(f_path, np_arr)
+
+def write_int(f_path, val):
+	with open(f_path, 'w') as fh:
+		fh.write('%d\n' % val)
+
+def read_int(f_path):
+	with open(f_path) as fh:
+		return int(fh.readline())
+
+def load_float_layers(p_dir):
+	scale = MaxVecScale(os.path.join(p_dir, 'vec_scale'))
+	pca_dir = os.path.join(p_dir, 'pca_layer')
+	pca_layer = MaxPCALayer(pca_dir) if os.path.exists(pca_dir) else None
+	dense_layers, acts = [], []
+	layer_dir = os.path.join(p_dir, 'dense_layer_0')
+	while os.path.exists(layer_dir):
+		dense_layers.append(MaxDenseLayer(layer_dir))
+		try:
+			with open(os.path.join(layer_dir, 'activation')) as fh:
+				acts.append(fh.readline().strip())
+		except FileNotFoundError:
+			acts.append('linear')
+		layer_dir = os.path.join(p_dir, 'dense_layer_%d' % len(dense_layers))
+	return scale, pca_layer, dense_layers, acts
+
+# Quantized runtime prototypes
+# ============================
+#
+# Integer reference implementations of the quantized layers. Inputs and outputs
+# are integers in each layer's in_frac/out_frac formats; accumulators are int64
+# here (int32 suffices for 8-bit models).
+class QuantLayer:
+	def __init__(self, layer_dir, bits):
+		self._bits = bits
+		self._in_frac = read_int(os.path.join(layer_dir, 'in_frac'))
+		self._out_frac = read_int(os.path.join(layer_dir, 'out_frac'))
+	def load(self, layer_dir, name):
+		return (np.load(os.path.join(layer_dir, name + '.npy')).astype(np.int64),
+			read_int(os.path.join(layer_dir, name + '_frac')))
+
+class QuantVecScale(QuantLayer):
+	def __init__(self, layer_dir, bits):
+		QuantLayer.__init__(self, layer_dir, bits)
+		self._scale, self._scale_frac = self.load(layer_dir, 'range')
+		self._inv_scale, self._inv_scale_frac = self.load(layer_dir, 'inv_range')
+		self._bias, _ = self.load(layer_dir, 'min')
+	def process_forward(self, inputs):
+		acc = inputs * self._scale
+		acc = shift(acc, self._in_frac + self._scale_frac - self._out_frac)
+		return saturate(acc + self._bias, self._bits)
+	def process_backward(self, inputs):
+		acc = (inputs - self._bias) * self._inv_scale
+		acc = shift(acc, self._out_frac + self._inv_scale_frac - self._in_frac)
+		return np.clip(acc, 0, qmax(self._bits))
+
+class QuantPCALayer(QuantLayer):
+	def __init__(self, layer_dir, bits):
+		QuantLayer.__init__(self, layer_dir, bits)
+		self._w, self._w_frac = self.load(layer_dir, 'weights')
+		self._wi, self._wi_frac = self.load(layer_dir, 'weights_inv')
+		self._b, _ = self.load(layer_dir, 'biases')
+	def process_forward(self, inputs):
+		acc = np.dot(inputs, self._wi)
+		acc = shift(acc, self._in_frac + self._wi_frac - self._out_frac)
+		return saturate(acc + self._b, self._bits)
+	def process_backward(self, inputs):
+		acc = np.dot(inputs - self._b, self._w)
+		return saturate(shift(acc, self._out_frac + self._w_frac - self._in_frac), self._bits)
+
+# Sigmoid layers map to and from MIDI values 0-127, linear layers to out_frac
+class QuantDenseLayer(QuantLayer):
+	def __init__(self, layer_dir, bits):
+		QuantLayer.__init__(self, layer_dir, bits)
+		self._w, self._w_frac = self.load(layer_dir, 'weights')
+		self._wi, self._wi_frac = self.load(layer_dir, 'weights_inv')
+		self._b, _ = self.load(layer_dir, 'biases')
+		self._sigmoid = os.path.exists(os.path.join(layer_dir, 'lut.npy'))
+		if self._sigmoid:
+			self._lut = np.load(os.path.join(layer_dir, 'lut.npy')).astype(np.int64)
+			self._lut_inv = np.load(os.path.join(layer_dir, 'lut_inv.npy')).astype(np.int64)
+			self._lut_shift = read_int(os.path.join(layer_dir, 'lut_shift'))
+			self._lut_clip = read_int(os.path.join(layer_dir, 'lut_clip'))
+	def process_forward(self, inputs):
+		acc = np.dot(inputs, self._w)
+		acc = shift(acc, self._in_frac + self._w_frac - self._out_frac) + self._b
+		if not self._sigmoid:
+			return saturate(acc, self._bits)
+		acc = np.clip(acc, -self._lut_clip, self._lut_clip)
+		return self._lut[shift(acc + self._lut_clip, self._lut_shift)]
+	def process_backward(self, inputs):
+		if self._sigmoid:
+			inputs = self._lut_inv[np.clip(inputs, 0, 127)]
+		acc = np.dot(inputs - self._b, self._wi)
+		return saturate(shift(acc, self._out_frac + self._wi_frac - self._in_frac), self._bits)
+
+# Full quantized mapping between controls c (in_frac = bits-1, i.e. [0, 1]) and
+# parameters p: MIDI values 0-127 if the output layer is a sigmoid (midi_out),
+# otherwise fixed point with p_frac fractional bits
+class QuantMapping:
+	def __init__(self, q_dir):
+		self.bits = read_int(os.path.join(q_dir, 'bits'))
+		self.c_frac = self.bits - 1
+		self._layers = [QuantVecScale(os.path.join(q_dir, 'vec_scale'), self.bits)]
+		if os.path.exists(os.path.join(q_dir, 'pca_layer')):
+			self._layers.append(QuantPCALayer(os.path.join(q_dir, 'pca_layer'), self.bits))
+		layer_idx = 0
+		layer_dir = os.path.join(q_dir, 'dense_layer_%d' % layer_idx)
+		while os.path.exists(layer_dir):
+			self._layers.append(QuantDenseLayer(layer_dir, self.bits))
+			layer_idx += 1
+			layer_dir = os.path.join(q_dir, 'dense_layer_%d' % layer_idx)
+		self.midi_out = self._layers[-1]._sigmoid
+		self.p_frac = 0 if self.midi_out else self._layers[-1]._out_frac
+	def process_forward(self, inputs):
+		patch = np.asarray(inputs, dtype=np.int64)
+		for layer in self._layers:
+			patch = layer.process_forward(patch)
+		return patch
+	def process_backward(self, inputs):
+		patch = np.asarray(inputs, dtype=np.int64)
+		for layer in reversed(self._layers):
+			patch = layer.process_backward(patch)
+		return patch
+
+# Evaluation
+# ==========
+#
+# Compare the quantized model in q_dir to the float model in p_dir on an n^d grid
+# of controls. Returns worst-case and mean parameter error in MIDI steps (against
+# the float output, and against the float output rounded to MIDI values), and
+# the worst-case c -> p -> c round-trip error in steps of 1/127 of the control
+# range. Linear outputs are compared in the float model's units (MIDI steps, as
+# the regressor is trained on MIDI values), and their round trips aren't rounded
+# or clipped to MIDI values, as the quantized model doesn't round them either.
+def quantize_report(p_dir, q_dir, n=33):
+	mapping = QuantMapping(q_dir)
+	scale, pca_layer, dense_layers, _ = load_float_layers(p_dir)
+	rng = np.linspace(0, 1, n)
+	c_q = to_fixed(np.array(np.meshgrid(*[rng] * len(scale._bias))).reshape(
+		(len(scale._bias), -1)).T, mapping.c_frac, mapping.bits)
+	c = to_float(c_q, mapping.c_frac)
+	# Float reference
+	p = scale.process_forward(c)
+	if pca_layer is not None:
+		p = pca_layer.process_forward(p)
+	for layer in dense_layers:
+		p = layer.process_forward(p)
+	if mapping.midi_out:
+		c_float = np.clip(np.round(p), 0.5, 126.5)
+	else:
+		c_float = p
+	for layer in reversed(dense_layers):
+		c_float = layer.process_backward(c_float)
+	if pca_layer is not None:
+		c_float = pca_layer.process_backward(c_float)
+	c_float = scale.process_backward(c_float)
+	# Quantized forward and round trip
+	p_q = mapping.process_forward(c_q)
+	c_hat = to_float(mapping.process_backward(p_q), mapping.c_frac)
+	p_hat = to_float(p_q, mapping.p_frac)
+	err = np.abs(p_hat - p)
+	return {
+		'bits': mapping.bits,
+		'max_err': float(err.max()),
+		'mean_err': float(err.mean()),
+		'max_step_err': int(np.abs(np.round(p_hat) - np.round(p)).max()),
+		'round_trip_err': float(np.abs(c_hat - c).max() * 127),
+		'float_round_trip_err': float(np.abs(c_float - c).max() * 127),
+	}
@@ -0,0 +1,94 @@
+import os
+import numpy as np
+from util.tests import MaxMapping, MaxGaussianScale
+from util.export import export_matrix
+
+# Sensitivity of the Control to Parameter Mapping
+# ===============================================
+#
+# Exact Jacobians dp/dc of the full c -> z* -> z -> p mapping, in MIDI steps per
+# unit of control. The PCA and dense layers compose into a single matrix W (see
+# MaxMapping.compose()), so for p = act(scale(c) W + b),
+#
+#     dp_j/dc_i = scale'(c_i) W_ij act'(pre_j)
+#
+# A sensitivity atlas samples the Jacobian on a regular grid over the control
+# space, and is exported to timbremap/sensitivity so controller UIs can look up
+# local sensitivity without the model.
+
+# Jacobians of a MaxMapping at a batch of controls c (N x latent_size). Returns
+# parameters p (N x n_params) and Jacobians J (N x latent_size x n_params).
+def jacobian(mapping, c):
+	w, b = mapping.compose()
+	scale = mapping.scale_layer
+	z = scale.process_forward(c)
+	if isinstance(scale, MaxGaussianScale):
+		# d/dc of mean + std * sqrt(2) * erfinv(2c - 1), for the exact erfinv
+		# (MaxGaussianScale uses an approximation)
+		u = (z - scale._mean) / scale._std
+		dz = scale._std * np.sqrt(2 * np.pi) * np.exp(0.5 * u * u)
+	else:
+		dz = np.broadcast_to(scale._scale, z.shape)
+	pre = np.dot(z, w) + b
+	act = mapping.dense_layers[-1].activation
+	if act == 'sigmoid':
+		p = 127.0 / (1 + np.exp(-pre))
+		dp = p * (1 - p / 127.0)
+	elif act == 'tanh':
+		p = np.tanh(pre)
+		dp = 1 - p * p
+	elif act == 'linear':
+		p = pre
+		dp = np.ones(p.shape)
+	else:
+		raise ValueError('Unsupported activation %s' % act)
+	return p, dz[:, :, np.newaxis] * w[np.newaxis] * dp[:, np.newaxis, :]
+
+# Sensitivity atlas
+# =================
+#
+# Sample Jacobians on an n^latent_size grid over [0, 1] controls and export them
+# to model_dir/sensitivity: 'size' (grid points per axis), 'jacobian.npy' (grid
+# x latent_size x n_params), and 'norm' (grid x latent_size; Euclidean norm of
+# each control axis's row of the Jacobian, also as text for Max). The grid is
+# ordered with the first control axis varying slowest.
+def export_sensitivity_atlas(model_dir, n=17):
+	if n < 2:
+		raise ValueError('Sensitivity atlases need at least 2 grid points per axis')
+	mapping = MaxMapping(model_dir)
+	d = len(mapping.compose()[0])
+	rng = np.linspace(0, 1, n)
+	c = np.stack(np.meshgrid(*[rng] * d, indexing='ij'), -1).reshape((-1, d))
+	_, jac = jacobian(mapping, c)
+	out_dir = os.path.join(model_dir, 'sensitivity')
+	if not os.path.exists(out_dir):
+		os.makedirs(out_dir)
+	with open(os.path.join(out_dir, 'size'), 'w') as fh:
+		fh.write('%d\n' % n)
+	np.save(os.path.join(out_dir, 'jacobian'), jac.reshape((n,) * d + jac.shape[1:]))
+	export_matrix(os.path.join(out_dir, 'norm'),
+		np.sqrt(np.sum(jac * jac, axis=2)).reshape((n,) * d + (d,)))
+	return out_dir
+
+# Multilinear interpolation of an exported atlas at controls c (N x latent_size)
+class SensitivityAtlas:
+	def __init__(self, atlas_dir):
+		self.jacobian = np.load(os.path.join(atlas_dir, 'jacobian.npy'))
+		self.norm = np.load(os.path.join(atlas_dir, 'norm.npy'))
+		self._n = self.norm.shape[0]
+		self._d = self.norm.ndim - 1
+	def query(self, c, norm=False):
+		grid = self.norm if norm else self.jacobian
+		x = np.clip(np.asarray(c, dtype=np.float64), 0, 1) * (self._n - 1)
+		i0 = np.minimum(np.floor(x).astype(int), self._n - 2)
+		frac = x - i0
+		out = 0
+		# Sum the 2^d surrounding grid points, weighted by their opposite volumes
+		for corner in range(2**self._d):
+			bits = [(corner >> k) & 1 for k in range(self._d)]
+			weight = np.prod([frac[:, k] if bit else 1 - frac[:, k]
+				for k, bit in enumerate(bits)], axis=0)
+			idx = tuple(i0[:, k] + bit for k, bit in enumerate(bits))
+			weight = weight.reshape((-1,) + (1,) * (grid.ndim - self._d))
+			out = out + weight * grid[idx]
+		return out
@@ -5,152 +5,311 @@ import numpy as np
 # runtime external
 def test_max(model_dir, scale_mode='uniform'):
 
-	# Parameters for mapping control space to latent space
-	if scale_mode == 'uniform':
-		scale_layer = MaxVecScale(os.path.join(model_dir, 'vec_scale'))
-	elif scale_mode == 'normal':
-		scale_layer = MaxGaussianScale(os.path.join(model_dir, 'vec_scale'))
-
-	# PCA layer
-	try:
-		pca_layer = MaxPCALayer(os.path.join(model_dir, 'pca_layer'))
-		use_pca = True
-	except:
-		use_pca = False
-
-	# Dense layer(s)
-	dense_layers = []
-	layer_idx = 0
-	layer_dir = os.path.join(model_dir, 'dense_layer_%d' % layer_idx)
-	while os.path.exists(layer_dir):
-		dense_layers.append(MaxDenseLayer(layer_dir))
-		layer_idx += 1
-		layer_dir = os.path.join(model_dir, 'dense_layer_%d' % layer_idx)
+	# Mapping layers
+	mapping = MaxMapping(model_dir, scale_mode)
 
 	# Test data
 	rng = np.linspace(0.01, 0.99, 10)
 	c = np.array([[i, j, k] for i in rng for j in rng for k in rng])
 
-	# Forward pass
-	patch = scale_layer.process_forward(c)
-	if use_pca:
-		patch = pca_layer.process_forward(patch)
-	for layer in dense_layers:
-		patch = layer.process_forward(patch)
-
-	# Backward pass
-	for layer in reversed(dense_layers):
-		patch = layer.process_backward(patch)
-	if use_pca:
-		patch = pca_layer.process_backward(patch)
-	c_hat = scale_layer.process_backward(patch)
+	# Forward and backward passes
+	c_hat = mapping.process_backward(mapping.process_forward(c))
 
 	# Return round-trip error per example
 	return np.sum(np.abs(c - c_hat)) / len(c)
 
+# Verify analytic Jacobians of the mapping (in util.sensitivity) against central
+# finite differences. Returns max. absolute error in MIDI steps per unit control.
+def test_jacobian(model_dir, h=1e-5):
+	from util.sensitivity import jacobian
+	mapping = MaxMapping(model_dir)
+	rng = np.linspace(0.01, 0.99, 5)
+	c = np.array([[i, j, k] for i in rng for j in rng for k in rng])
+	_, jac = jacobian(mapping, c)
+	err = 0
+	for i in range(c.shape[1]):
+		dc = np.zeros(c.shape[1])
+		dc[i] = h
+		fd = (mapping.process_forward(c + dc) - mapping.process_forward(c - dc)) / (2 * h)
+		err = max(err, np.max(np.abs(fd - jac[:, i, :])))
+	return err
+
+# Micro-benchmark the mapping's layers (and the full mapping) forward and backward
+# on batches of random controls, with and without out= buffers. Reports ns per
+# vector and the peak bytes allocated per call (traced by tracemalloc, to which
+# numpy reports its array allocations), after one warm-up call.
+def benchmark_layers(model_dir, batch_shape=(4096,), dtype=np.float32, repeats=100):
+	import time
+	import tracemalloc
+	mapping = MaxMapping(model_dir, dtype=dtype)
+	c = np.random.RandomState(0).uniform(0.01, 0.99,
+		batch_shape + (mapping.scale_layer.n_in,)).astype(dtype)
+	n_vectors = int(np.prod(batch_shape))
+	# Each layer's inputs in both directions
+	cases = []
+	x = c
+	for layer in mapping.layers:
+		cases.append((type(layer).__name__, 'forward', layer.process_forward, x))
+		x = layer.process_forward(x)
+	cases.append(('MaxMapping', 'forward', mapping.process_forward, c))
+	cases.append(('MaxMapping', 'backward', mapping.process_backward, x))
+	for layer in reversed(mapping.layers):
+		cases.insert(-1, (type(layer).__name__, 'backward', layer.process_backward, x))
+		x = layer.process_backward(x)
+	results = []
+	print('layer              direction  out    ns/vector  alloc bytes')
+	for name, direction, func, inputs in cases:
+		for buffered in (False, True):
+			out = np.empty_like(func(inputs)) if buffered else None
+			func(inputs, out)
+			tracemalloc.start()
+			base = tracemalloc.get_traced_memory()[0]
+			func(inputs, out)
+			alloc = tracemalloc.get_traced_memory()[1] - base
+			tracemalloc.stop()
+			t = time.perf_counter()
+			for _ in range(repeats):
+				func(inputs, out)
+			ns = (time.perf_counter() - t) / (repeats * n_vectors) * 1e9
+			results.append({'layer': name, 'direction': direction, 'out': buffered,
+				'ns_per_vector': ns, 'alloc_bytes': alloc})
+			print('%-18s %-9s  %-5s  %9.2f  %11d' % (name, direction, buffered, ns, alloc))
+	return results
+
 # Max/MSP external tests/prototypes
 # =================================
 #
+# Layers run in the given dtype (float32 as in the external, or float64), on
+# inputs with any number of leading batch dimensions. process_forward() and
+# process_backward() write to out if given; intermediate results are kept in
+# buffers reused by later calls with the same shape, so repeated calls with out=
+# don't allocate (except for MaxGaussianScale). Biases and scales are also
+# tiled to the batch shape once, as numpy's broadcasting of short vectors over a
+# batch is much slower than element-wise operations, and allocates.
+#
+# Full mapping from control space to parameter space, as loaded by the Max/MSP
+# external from a timbremap model directory
+class MaxMapping:
+	def __init__(self, model_dir, scale_mode='uniform', dtype=np.float64):
+
+		# Parameters for mapping control space to latent space
+		if scale_mode == 'uniform':
+			self.scale_layer = MaxVecScale(os.path.join(model_dir, 'vec_scale'), dtype)
+		elif scale_mode == 'normal':
+			self.scale_layer = MaxGaussianScale(os.path.join(model_dir, 'vec_scale'), dtype)
+
+		# PCA layer
+		try:
+			self.pca_layer = MaxPCALayer(os.path.join(model_dir, 'pca_layer'), dtype)
+		except FileNotFoundError:
+			self.pca_layer = None
+
+		# Dense layer(s)
+		self.dense_layers = []
+		layer_idx = 0
+		layer_dir = os.path.join(model_dir, 'dense_layer_%d' % layer_idx)
+		while os.path.exists(layer_dir):
+			self.dense_layers.append(MaxDenseLayer(layer_dir, dtype))
+			layer_idx += 1
+			layer_dir = os.path.join(model_dir, 'dense_layer_%d' % layer_idx)
+
+		# All layers in forward order
+		self.layers = [self.scale_layer]
+		if self.pca_layer is not None:
+			self.layers.append(self.pca_layer)
+		self.layers += self.dense_layers
+		self._dtype = dtype
+		self._buffers = {}
+
+	def process_forward(self, inputs, out=None):
+		patch = inputs
+		for idx, layer in enumerate(self.layers[:-1]):
+			buf = get_buffer(self._buffers, ('forward', idx),
+				np.shape(patch)[:-1] + (layer.n_out,), self._dtype)
+			patch = layer.process_forward(patch, buf)
+		return self.layers[-1].process_forward(patch, out)
+
+	def process_backward(self, inputs, out=None):
+		patch = inputs
+		for idx, layer in reversed(list(enumerate(self.layers))[1:]):
+			buf = get_buffer(self._buffers, ('backward', idx),
+				np.shape(patch)[:-1] + (layer.n_in,), self._dtype)
+			patch = layer.process_backward(patch, buf)
+		return self.layers[0].process_backward(patch, out)
+
+	# Compose the PCA and dense layers into a single weight matrix and bias,
+	# mapping z* to the last dense layer's pre-activation. All but the last dense
+	# layer must be linear.
+	def compose(self):
+		for layer in self.dense_layers[:-1]:
+			if layer.activation != 'linear':
+				raise ValueError('Only the last dense layer may have an activation')
+		w = np.eye(self.dense_layers[0]._w.shape[0])
+		b = np.zeros(len(w))
+		if self.pca_layer is not None:
+			w = self.pca_layer._wi
+			b = self.pca_layer._b
+		for layer in self.dense_layers:
+			w = np.dot(w, layer._w)
+			b = np.dot(b, layer._w) + layer._b
+		return w, b
+
+# Return the array buffers[key], (re-)allocating it if it doesn't have shape
+def get_buffer(buffers, key, shape, dtype):
+	buf = buffers.get(key)
+	if buf is None or buf.shape != shape:
+		buf = buffers[key] = np.empty(shape, dtype)
+	return buf
+
+# Return vec tiled to shape, cached in buffers[key]
+def get_tiled(buffers, key, vec, shape):
+	buf = buffers.get(key)
+	if buf is None or buf.shape != shape:
+		buf = buffers[key] = np.ascontiguousarray(np.broadcast_to(vec, shape))
+	return buf
+
 class MaxLayer:
-	def __init__(self, layer_dir):
-		self._w = np.load(os.path.join(layer_dir, 'weights.npy'))
-		self._wi = np.load(os.path.join(layer_dir, 'weights_inv.npy'))
-		self._b = np.load(os.path.join(layer_dir, 'biases.npy'))
-		return
+	def __init__(self, layer_dir, dtype=np.float64):
+		self._w = np.load(os.path.join(layer_dir, 'weights.npy')).astype(dtype)
+		self._wi = np.load(os.path.join(layer_dir, 'weights_inv.npy')).astype(dtype)
+		self._b = np.load(os.path.join(layer_dir, 'biases.npy')).astype(dtype)
+		self.n_in, self.n_out = self._w.shape
+		self._dtype = dtype
+		self._buffers = {}
+	def _out(self, out, shape):
+		return np.empty(shape, self._dtype) if out is None else out
 
 class MaxDenseLayer(MaxLayer):
-	def __init__(self, layer_dir):
-		MaxLayer.__init__(self, layer_dir)
+	def __init__(self, layer_dir, dtype=np.float64):
+		MaxLayer.__init__(self, layer_dir, dtype)
 		try:
 			f = open(os.path.join(layer_dir, 'activation'))
 			lines = [line.rstrip('\n') for line in f]
 			f.close()
 		except:
 			lines = ['linear']
-		if lines[0] == 'linear':
-			self._act = lambda x: x
-			self._act_inv = lambda x: x
+		self.activation = lines[0]
+		if lines[0] in ('linear', 'leakyrelu'):		# TO DO: actually implement leakyrelu
+			self._act = self._linear
+			self._act_inv = self._linear
 		elif lines[0] == 'sigmoid':
-			self._act = lambda x: (np.exp(x) / (np.exp(x) + 1)) * 127.0
-			self._act_inv = lambda x: np.log((x/127.0) / (1 - (x/127.0) + 0.0000000001))
+			self._act = self._sigmoid
+			self._act_inv = self._sigmoid_inv
 		elif lines[0] == 'tanh':
-			self._act = lambda x: np.tanh(x)
-			self._act_inv = lambda x: np.atanh(x)
-		elif lines[0] == 'leakyrelu':		# TO DO: actually implement this
-			self._act = lambda x: x
-			self._act_inv = lambda x: x
-	def process_forward(self, inputs):
-		return self._act(np.dot(inputs, self._w) + self._b)
-	def process_backward(self, inputs):
-		return np.dot(self._act_inv(inputs) - self._b, self._wi)
+			self._act = self._tanh
+			self._act_inv = self._tanh_inv
+		else:
+			raise ValueError('Unsupported activation %s' % lines[0])
+		# Clipping bounds: exp(clip) is finite, and tiny and 1 - epsneg are the
+		# smallest and largest values with finite logits
+		info = np.finfo(dtype)
+		self._clip = np.floor(np.log(info.max))
+		self._lo = info.tiny
+		self._hi = 1 - info.epsneg
+	def process_forward(self, inputs, out=None):
+		out = np.matmul(inputs, self._w, out=self._out(out, np.shape(inputs)[:-1] + (self.n_out,)))
+		out += get_tiled(self._buffers, 'b', self._b, out.shape)
+		return self._act(out, out)
+	def process_backward(self, inputs, out=None):
+		patch = get_buffer(self._buffers, 'backward', np.shape(inputs), self._dtype)
+		self._act_inv(inputs, patch)
+		patch -= get_tiled(self._buffers, 'b', self._b, patch.shape)
+		return np.matmul(patch, self._wi, out=self._out(out, patch.shape[:-1] + (self.n_in,)))
+
+	# Activations and their inverses, computed in place in out
+	def _linear(self, x, out):
+		np.copyto(out, x)
+		return out
+	# 127 / (1 + exp(-x)), with x clipped so exp() can't overflow
+	def _sigmoid(self, x, out):
+		np.clip(x, -self._clip, self._clip, out=out)
+		np.negative(out, out=out)
+		np.exp(out, out=out)
+		out += 1
+		return np.divide(127.0, out, out=out)
+	# logit(x / 127) = -log(127 / x - 1), with x / 127 clipped to (0, 1)
+	def _sigmoid_inv(self, x, out):
+		np.multiply(x, 1 / 127.0, out=out)
+		np.clip(out, self._lo, self._hi, out=out)
+		np.reciprocal(out, out=out)
+		out -= 1
+		np.log(out, out=out)
+		return np.negative(out, out=out)
+	def _tanh(self, x, out):
+		return np.tanh(x, out=out)
+	def _tanh_inv(self, x, out):
+		np.clip(x, -self._hi, self._hi, out=out)
+		return np.arctanh(out, out=out)
 
 class MaxPCALayer(MaxLayer):
-	def __init__(self, layer_dir):
-		MaxLayer.__init__(self, layer_dir)
-		return 
-	def process_forward(self, inputs):
-		return np.dot(inputs, self._wi) + self._b
-	def process_backward(self, inputs):
-		return np.dot(inputs - self._b, self._w)
-
-class MaxVecScale:
-	def __init__(self, rescale_dir):
-		self._bias = np.load(os.path.join(rescale_dir, 'min.npy'))
-		self._scale = np.load(os.path.join(rescale_dir, 'range.npy'))
-		return
-	def process_forward(self, inputs):
-		return inputs * self._scale + self._bias
-	def process_backward(self, inputs):
-		return (inputs - self._bias) / self._scale
-
-class MaxGaussianScale:
-	def __init__(self, rescale_dir):
-		self._mean = np.load(os.path.join(rescale_dir, 'mean.npy'))
-		self._std = np.load(os.path.join(rescale_dir, 'std.npy'))
-		return
-	def process_forward(self, inputs):
+	def __init__(self, layer_dir, dtype=np.float64):
+		MaxLayer.__init__(self, layer_dir, dtype)
+	def process_forward(self, inputs, out=None):
+		out = np.matmul(inputs, self._wi, out=self._out(out, np.shape(inputs)[:-1] + (self.n_out,)))
+		out += get_tiled(self._buffers, 'b', self._b, out.shape)
+		return out
+	def process_backward(self, inputs, out=None):
+		patch = get_buffer(self._buffers, 'backward', np.shape(inputs), self._dtype)
+		np.subtract(inputs, get_tiled(self._buffers, 'b', self._b, patch.shape), out=patch)
+		return np.matmul(patch, self._w, out=self._out(out, patch.shape[:-1] + (self.n_in,)))
+
+class MaxVecScale(MaxLayer):
+	def __init__(self, rescale_dir, dtype=np.float64):
+		self._bias = np.load(os.path.join(rescale_dir, 'min.npy')).astype(dtype)
+		self._scale = np.load(os.path.join(rescale_dir, 'range.npy')).astype(dtype)
+		self.n_in = self.n_out = len(self._scale)
+		self._dtype = dtype
+		self._buffers = {}
+	def process_forward(self, inputs, out=None):
+		shape = np.shape(inputs)
+		out = np.multiply(inputs, get_tiled(self._buffers, 'scale', self._scale, shape),
+			out=self._out(out, shape))
+		out += get_tiled(self._buffers, 'bias', self._bias, shape)
+		return out
+	def process_backward(self, inputs, out=None):
+		shape = np.shape(inputs)
+		out = np.subtract(inputs, get_tiled(self._buffers, 'bias', self._bias, shape),
+			out=self._out(out, shape))
+		out /= get_tiled(self._buffers, 'scale', self._scale, shape)
+		return out
+
+class MaxGaussianScale(MaxLayer):
+	def __init__(self, rescale_dir, dtype=np.float64):
+		self._mean = np.load(os.path.join(rescale_dir, 'mean.npy')).astype(dtype)
+		self._std = np.load(os.path.join(rescale_dir, 'std.npy')).astype(dtype)
+		self.n_in = self.n_out = len(self._mean)
+		self._dtype = dtype
+	def process_forward(self, inputs, out=None):
 		# return norm.ppf(inputs, loc=self._mean, scale=self._std)
-		return norm_ppf(inputs, self._mean, self._std)
-	def process_backward(self, inputs):
+		out = self._out(out, np.shape(inputs))
+		np.copyto(out, norm_ppf(inputs, self._mean, self._std))
+		return out
+	def process_backward(self, inputs, out=None):
 		# return norm.cdf(inputs, loc=self._mean, scale=self._std)
-		return norm_cdf(inputs, self._mean, self._std)
+		out = self._out(out, np.shape(inputs))
+		np.copyto(out, norm_cdf(inputs, self._mean, self._std))
+		return out
 
 def norm_cdf(x, mu=0.0, sig=1.0):
-	return 0.5 * (1 + erf((x - mu) / (sig*2**0.5)))
+	return 0.5 * (1 + util_erf((x - mu) / (sig*2**0.5)))
 
 def norm_ppf(x, mu=0.0, sig=1.0):
-	return mu + sig*2**0.5 * erfi(2*x - 1)
-
-def erf(x):
-	y = np.zeros(x.shape)
-	for i in range(x.shape[0]):
-		for j in range(x.shape[1]):
-			y[i, j] = util_erf(x[i, j])
-	return y
-
-def erfi(x):
-	y = np.zeros(x.shape)
-	for i in range(x.shape[0]):
-		for j in range(x.shape[1]):
-			y[i, j] = util_erf_inv(x[i, j])
-	return y
+	return mu + sig*2**0.5 * util_erf_inv(2*x - 1)
 
 # Forward and inverse error functions taken from:
 # https://stackoverflow.com/questions/27229371/inverse-error-function-in-c
 # which was taken from a 2008 paper
 # http://www.academia.edu/9730974/A_handy_approximation_for_the_error_function_and_its_inverse
+# (element-wise, for arrays of any shape)
 def util_erf(x):
-	sgn = -1.0 if x < 0 else 1.0
+	sgn = np.where(x < 0, -1.0, 1.0)
 	xx = x * x
 	axx = 0.147 * xx
 	return sgn * (1 - np.exp(-xx * (4/np.pi + axx) / (1 + axx))) ** 0.5
 
 def util_erf_inv(x):
-	sgn = -1.0 if x < 0 else 1.0
+	sgn = np.where(x < 0, -1.0, 1.0)
 	lnx = np.log((1 - x) * (1 + x))
 	tt1 = 2 / (np.pi * 0.147) + 0.5 * lnx
 	tt2 = 1 / (0.147) * lnx
 	return sgn * np.sqrt((-tt1 + np.sqrt(tt1 * tt1 - tt2)))
-
-
-
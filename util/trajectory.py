@@ -0,0 +1,162 @@
+import numpy as np
+from util.tests import MaxMapping
+
+# Trajectory Rendering
+# ====================
+#
+# Renders control trajectories (T x latent_size arrays of c-vectors, e.g. a
+# recorded BLOCKS gesture) through a timbremap model into parameter automation.
+# Trajectories are streamed in chunks, so they may be memory-mapped. The scale,
+# PCA and any linear dense layers are affine, so they're composed into a single
+# matrix and bias, leaving one matrix product and the output activation per
+# chunk.
+#
+# Rendered automation is a stream of MIDI CC style events (frame, param, value),
+# with values rounded and clipped to 0-127. Optionally, controls are smoothed
+# with a one-pole lowpass filter, frames are decimated to limit the event rate,
+# and events that don't change a parameter's value are dropped.
+
+class TrajectoryRenderer:
+	def __init__(self, model_dir, dtype=np.float32):
+		mapping = MaxMapping(model_dir)
+		self._act = mapping.dense_layers[-1].activation
+		if self._act not in ('linear', 'sigmoid', 'tanh'):
+			raise ValueError('Unsupported activation %s' % self._act)
+		# Compose c -> z* -> z -> pre-activation
+		w, b = mapping.compose()
+		b = np.dot(mapping.scale_layer._bias, w) + b
+		w = mapping.scale_layer._scale[:, np.newaxis] * w
+		self._w = w.astype(dtype)
+		self._b = b.astype(dtype)
+		self._dtype = dtype
+		self.latent_size, self.n_params = w.shape
+
+	# Map a chunk of controls to (unrounded) parameter values
+	def process_forward(self, inputs):
+		patch = np.dot(np.asarray(inputs, dtype=self._dtype), self._w)
+		patch += self._b
+		if self._act == 'sigmoid':
+			np.negative(patch, out=patch)
+			np.exp(patch, out=patch)
+			patch += 1
+			np.divide(127.0, patch, out=patch)
+		elif self._act == 'tanh':
+			np.tanh(patch, out=patch)
+		return patch
+
+	# Yield (frames, params, values) arrays of events for each chunk of the
+	# trajectory c. smooth is the lowpass time constant in frames, and only every
+	# stride-th frame (and the last) is rendered. If dedupe is True, events are
+	# only emitted when a parameter's MIDI value changes.
+	def render(self, c, chunk_size=65536, smooth=None, stride=1, dedupe=True):
+		n = len(c)
+		last = np.full(self.n_params, -1, dtype=np.int16)
+		zi = None
+		for start in range(0, n, chunk_size):
+			stop = min(start + chunk_size, n)
+			chunk = np.asarray(c[start:stop], dtype=self._dtype)
+			if smooth:
+				chunk, zi = lowpass(chunk, smooth, zi)
+			# Frames to render (global frame indices)
+			frames = np.arange(start, stop)
+			keep = (frames % stride == stride - 1) | (frames == n - 1)
+			if stride > 1:
+				frames = frames[keep]
+				chunk = chunk[keep]
+			if not len(frames):
+				continue
+			# Clip to MIDI data values (linear and tanh outputs aren't bounded to
+			# 0-127)
+			values = np.clip(np.round(self.process_forward(chunk)), 0, 127).astype(np.int16)
+			if dedupe:
+				prev = np.concatenate((last[np.newaxis], values[:-1]))
+				t, j = np.nonzero(values != prev)
+			else:
+				t, j = np.indices(values.shape).reshape((2, -1))
+			last = values[-1]
+			yield frames[t], j, values[t, j].astype(np.uint8)
+
+# One-pole lowpass filter along axis 0, with time constant tau in frames.
+# Returns the filtered chunk and the filter state for the next chunk.
+def lowpass(x, tau, zi=None):
+	from scipy.signal import lfilter
+	a = np.exp(-1.0 / tau)
+	if zi is None:
+		zi = a * x[:1]		# Start at rest at the first frame
+	y, zi = lfilter([1 - a], [1, -a], x, axis=0, zi=zi)
+	return y.astype(x.dtype), zi
+
+# Render the trajectory c through the model in model_dir to a CSV file
+# (f_path.csv) or a MIDI file (f_path.mid). Returns the number of events.
+def render_trajectory(model_dir, c, f_path, frame_rate=1000.0, max_rate=None, **kwargs):
+	renderer = TrajectoryRenderer(model_dir)
+	if max_rate is not None:
+		kwargs['stride'] = max(1, int(np.ceil(frame_rate / max_rate)))
+	events = renderer.render(c, **kwargs)
+	if f_path.endswith('.mid'):
+		return write_midi(f_path, events, frame_rate)
+	return write_csv(f_path, events, frame_rate)
+
+# Writing automation
+# ==================
+#
+# Write events as CSV rows of frame, time (s), param, value
+def write_csv(f_path, events, frame_rate=1000.0):
+	count = 0
+	with open(f_path, 'w') as fh:
+		fh.write('frame,time,param,value\n')
+		for frames, params, values in events:
+			rows = np.empty(len(frames), dtype=[('f', np.int64), ('t', np.float64),
+				('p', np.int64), ('v', np.int64)])
+			rows['f'] = frames
+			rows['t'] = frames / frame_rate
+			rows['p'] = params
+			rows['v'] = values
+			np.savetxt(fh, rows, fmt='%d,%.6f,%d,%d')
+			count += len(frames)
+	return count
+
+# Write events to a type 0 MIDI file as control changes on one channel, with
+# parameter i sent as CC number ccs[i] (default 20 + i). Time is 120 bpm with
+# 480 ticks per quarter note, i.e. 960 ticks per second.
+def write_midi(f_path, events, frame_rate=1000.0, channel=0, ccs=None, ticks_per_beat=480):
+	ticks_per_sec = ticks_per_beat * 2
+	track = []
+	count = 0
+	last_tick = 0
+	for frames, params, values in events:
+		if not len(frames):
+			continue
+		ticks = np.round(frames * (ticks_per_sec / frame_rate)).astype(np.int64)
+		deltas = np.diff(np.concatenate(([last_tick], ticks)))
+		last_tick = ticks[-1]
+		cc = (20 + params) if ccs is None else np.asarray(ccs)[params]
+		if np.any(cc > 119):
+			raise ValueError('CC numbers must be below 120')
+		track.append(midi_events(deltas, 0xB0 | channel, cc, values))
+		count += len(frames)
+	track.append(b'\x00\xff\x2f\x00')		# End of track
+	track = b''.join(track)
+	with open(f_path, 'wb') as fh:
+		fh.write(b'MThd' + (6).to_bytes(4, 'big') + (0).to_bytes(2, 'big') +
+			(1).to_bytes(2, 'big') + ticks_per_beat.to_bytes(2, 'big'))
+		fh.write(b'MTrk' + len(track).to_bytes(4, 'big') + track)
+	return count
+
+# Encode delta times (as variable-length quantities) and 3-byte messages
+def midi_events(deltas, status, data1, data2):
+	n = len(deltas)
+	msg = np.zeros((n, 7), dtype=np.uint8)
+	valid = np.zeros((n, 7), dtype=bool)
+	n_bytes = 1 + (deltas >= 1 << 7) + (deltas >= 1 << 14) + (deltas >= 1 << 21)
+	for k in range(4):
+		# Byte k of the quantity holds bits 7*(3-k) and up, continuation bit set
+		# on all but the last
+		shift = 7 * (3 - k)
+		msg[:, k] = ((deltas >> shift) & 0x7F) | (0x80 if k < 3 else 0)
+		valid[:, k] = n_bytes > 3 - k
+	msg[:, 4] = status
+	msg[:, 5] = data1
+	msg[:, 6] = data2
+	valid[:, 4:] = True
+	return msg[valid].tobytes()
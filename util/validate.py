@@ -0,0 +1,161 @@
+import os
+import time
+import shutil
+import tempfile
+import traceback
+import multiprocessing
+import numpy as np
+from util.export import export_model
+from util.tests import MaxMapping
+
+# Validating Exported Models
+# ==========================
+#
+# Checks every model under a directory (e.g. patches/*/models/*, or a sweep of
+# trained models) in a pool of worker processes, and collects one report. For
+# each model:
+#
+#   rebuild:   re-export the runtime model from keras/ and latent.npy into a
+#              scratch directory (or, with write=True, over model_dir/timbremap),
+#              and compare it to the existing timbremap/ export
+#   text:      each exported matrix's text file agrees with its .npy file
+#   inverse:   weights_inv inverts weights (a right inverse if the layer
+#              widens, as the backward pass needs; a left inverse otherwise)
+#   mapping:   forward/backward round trip error of the c -> p mapping, and
+#              its time per control vector
+#
+# Errors are maximum absolute differences. For rebuilt matrices, they're relative
+# to the largest absolute value of the existing matrix, if above 1.
+
+# Runtime layer directories compared and checked (sensitivity/ and quantized
+# exports are derived from these)
+def layer_dirs(p_dir):
+	names = ['vec_scale', 'pca_layer']
+	idx = 0
+	while os.path.exists(os.path.join(p_dir, 'dense_layer_%d' % idx)):
+		names.append('dense_layer_%d' % idx)
+		idx += 1
+	return [name for name in names if os.path.exists(os.path.join(p_dir, name))]
+
+# Model directories (with keras/ and timbremap/ sub-directories) under root
+def find_models(root):
+	models = []
+	for dir_path, dir_names, _ in os.walk(root):
+		if 'keras' in dir_names and 'timbremap' in dir_names:
+			models.append(dir_path)
+	return sorted(models)
+
+# Validate the models in model_dirs with 'workers' processes. Returns a list of
+# per-model reports, with 'passed' True if all errors are within tol.
+def validate_models(model_dirs, workers=None, write=False, tol=1e-5, n=4096, repeats=20):
+	args = [(model_dir, write, tol, n, repeats) for model_dir in model_dirs]
+	with multiprocessing.Pool(workers) as pool:
+		return pool.starmap(validate_model, args)
+
+def validate_model(model_dir, write=False, tol=1e-5, n=4096, repeats=20):
+	report = {'model_dir': model_dir}
+	try:
+		p_dir = os.path.join(model_dir, 'timbremap')
+		report['rebuild'], report['export_sec'] = check_rebuild(model_dir, write)
+		report['text'] = {}
+		report['inverse'] = {}
+		for name in layer_dirs(p_dir):
+			layer_dir = os.path.join(p_dir, name)
+			for f_name in sorted(os.listdir(layer_dir)):
+				if f_name.endswith('.npy'):
+					report['text']['%s/%s' % (name, f_name[:-4])] = check_text(
+						os.path.join(layer_dir, f_name[:-4]))
+			if os.path.exists(os.path.join(layer_dir, 'weights_inv.npy')):
+				report['inverse'][name] = check_inverse(layer_dir)
+		report.update(check_mapping(p_dir, n, repeats))
+		errs = list(report['rebuild'].values()) + list(report['text'].values()) + \
+			list(report['inverse'].values()) + [report['round_trip_err']]
+		report['max_err'] = max(errs)
+		report['passed'] = bool(report['max_err'] <= tol)
+	except Exception:
+		report['error'] = traceback.format_exc()
+		report['passed'] = False
+	return report
+
+# Re-export model_dir's runtime model and compare it to the existing export.
+# Returns the relative error of each rebuilt matrix, and the export time.
+def check_rebuild(model_dir, write=False):
+	p_dir = os.path.join(model_dir, 'timbremap')
+	use_pca = os.path.exists(os.path.join(model_dir, 'latent_pca.npy'))
+	shipped = {}
+	for name in layer_dirs(p_dir):
+		layer_dir = os.path.join(p_dir, name)
+		for f_name in os.listdir(layer_dir):
+			if f_name.endswith('.npy'):
+				shipped['%s/%s' % (name, f_name[:-4])] = np.load(os.path.join(layer_dir, f_name))
+	if write:
+		out_dir = model_dir
+	else:
+		# Scratch model directory sharing the Keras weights and latent space data
+		out_dir = tempfile.mkdtemp()
+		os.symlink(os.path.abspath(os.path.join(model_dir, 'keras')),
+			os.path.join(out_dir, 'keras'))
+		os.symlink(os.path.abspath(os.path.join(model_dir, 'latent.npy')),
+			os.path.join(out_dir, 'latent.npy'))
+	try:
+		t = time.time()
+		new_dir = export_model(out_dir, use_pca=use_pca)
+		t = time.time() - t
+		errs = {}
+		for key, ref in shipped.items():
+			f_path = os.path.join(new_dir, key + '.npy')
+			if not os.path.exists(f_path):
+				errs[key] = np.inf
+				continue
+			new = np.load(f_path)
+			if new.shape != ref.shape:
+				errs[key] = np.inf
+				continue
+			errs[key] = float(np.max(np.abs(new - ref)) / max(np.max(np.abs(ref)), 1))
+	finally:
+		if not write:
+			shutil.rmtree(out_dir)
+	return errs, t
+
+# Max. absolute difference between the text file f_path and f_path.npy
+def check_text(f_path):
+	ref = np.load(f_path + '.npy').flatten()
+	text = np.loadtxt(f_path, ndmin=1)
+	if text.shape != ref.shape:
+		return np.inf
+	return float(np.max(np.abs(text - ref), initial=0))
+
+# Max. absolute difference between weights_inv weights (or weights weights_inv)
+# and the identity
+def check_inverse(layer_dir):
+	w = np.load(os.path.join(layer_dir, 'weights.npy')).astype(np.float64)
+	wi = np.load(os.path.join(layer_dir, 'weights_inv.npy')).astype(np.float64)
+	prod = np.dot(w, wi) if w.shape[0] <= w.shape[1] else np.dot(wi, w)
+	return float(np.max(np.abs(prod - np.eye(len(prod)))))
+
+# Round trip error and ns per control vector forward and backward through the
+# float32 mapping, for n random controls
+def check_mapping(p_dir, n=4096, repeats=20):
+	mapping = MaxMapping(p_dir, dtype=np.float32)
+	c = np.random.RandomState(0).uniform(0.01, 0.99,
+		(n, mapping.scale_layer.n_in)).astype(np.float32)
+	p = np.empty((n, mapping.dense_layers[-1].n_out), np.float32)
+	c_hat = np.empty_like(c)
+	mapping.process_backward(mapping.process_forward(c, p), c_hat)
+	t = time.perf_counter()
+	for _ in range(repeats):
+		mapping.process_forward(c, p)
+	t_forward = time.perf_counter() - t
+	t = time.perf_counter()
+	for _ in range(repeats):
+		mapping.process_backward(p, c_hat)
+	t_backward = time.perf_counter() - t
+	# Round trip error in float64, as the external's float32 precision limits
+	# invertibility of saturated parameters
+	mapping = MaxMapping(p_dir)
+	c = c.astype(np.float64)
+	return {
+		'round_trip_err': float(np.max(np.abs(mapping.process_backward(mapping.process_forward(c)) - c))),
+		'forward_ns': t_forward / (repeats * n) * 1e9,
+		'backward_ns': t_backward / (repeats * n) * 1e9,
+	}